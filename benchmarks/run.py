@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from io import BytesIO
+from urllib.parse import urlsplit, urlunsplit
+
+from lxml import etree
+
+from benchmarks.synthetic import SIZES, make_atb_receipt, make_tax_receipt, make_items
+from parsers.xml_parser import parse_xml_bytes, parse_format_atb, parse_format_tax, iter_xml_items
+from utils.categories import categorize, clear_category_cache
+from utils import db, report_cache
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Окремий сервер Postgres для бенчмарків бази; на ньому створюється і видаляється тимчасова база
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+
+# === Вимірювання ===
+
+def measure(fn, repeat, budget=2.0):
+    # Медіана часу одного виклику; великі розміри обмежуються бюджетом у секундах
+    timings = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+        if time.perf_counter() - started > budget and len(timings) >= 3:
+            break
+    return statistics.median(timings)
+
+async def measure_async(fn, repeat, budget=2.0):
+    timings = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - t0)
+        if time.perf_counter() - started > budget and len(timings) >= 3:
+            break
+    return statistics.median(timings)
+
+# === Парсери і категоризатор ===
+
+def bench_parsers(sizes, repeat):
+    results = {}
+    for size_name in sizes:
+        lines = SIZES[size_name]
+        atb = make_atb_receipt(lines, seed=lines)
+        tax = make_tax_receipt(lines, seed=lines)
+        atb_root = etree.fromstring(atb)
+        tax_root = etree.fromstring(tax)
+        results[f"parse_xml_bytes/atb/{size_name}"] = measure(lambda: parse_xml_bytes(atb), repeat)
+        results[f"parse_xml_bytes/tax/{size_name}"] = measure(lambda: parse_xml_bytes(tax), repeat)
+        results[f"parse_format_atb/{size_name}"] = measure(lambda: parse_format_atb(atb_root), repeat)
+        results[f"parse_format_tax/{size_name}"] = measure(lambda: parse_format_tax(tax_root), repeat)
+        results[f"iter_xml_items/atb/{size_name}"] = measure(
+            lambda: sum(1 for _ in iter_xml_items(BytesIO(atb))), repeat
+        )
+    return results
+
+def bench_categorize(repeat):
+    names = [item["name"] for item in make_items(2000, seed=7)]
+
+    def cold():
+        clear_category_cache()
+        for name in names:
+            categorize(name)
+
+    def warm():
+        for name in names:
+            categorize(name)
+
+    warm()
+    return {
+        "categorize/2000/cold": measure(cold, repeat),
+        "categorize/2000/warm": measure(warm, repeat),
+    }
+
+# === База даних ===
+
+def with_database(url, name):
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path="/" + name))
+
+async def bench_db(url, repeat):
+    import psycopg
+    scratch = f"bench_{os.getpid()}"
+    async with await psycopg.AsyncConnection.connect(url, autocommit=True) as admin:
+        await admin.execute(f"CREATE DATABASE {scratch};")
+    try:
+        await db.init_db(with_database(url, scratch))
+        results = {}
+        seed = iter(range(1, 10 ** 9))
+        for lines in (SIZES["tiny"], SIZES["medium"], SIZES["large"]):
+            async def save():
+                await db.save_items_to_db(1, make_items_cached(lines, next(seed)))
+            results[f"save_items_to_db/{lines}"] = await measure_async(save, repeat)
+
+        async def report():
+            report_cache.clear()
+            await db.get_report(1, "all")
+        results["get_report/all"] = await measure_async(report, repeat)
+
+        async def report_week():
+            report_cache.clear()
+            await db.get_report(1, "week")
+        results["get_report/week"] = await measure_async(report_week, repeat)
+        await db.close_db()
+    finally:
+        async with await psycopg.AsyncConnection.connect(url, autocommit=True) as admin:
+            await admin.execute(f"DROP DATABASE IF EXISTS {scratch};")
+    return results
+
+_ITEMS_CACHE = {}
+
+def make_items_cached(lines, seed):
+    # Генерація не повинна потрапляти у виміряний час: назви беремо з кешу, міняємо дату
+    items = _ITEMS_CACHE.get(lines)
+    if items is None:
+        items = _ITEMS_CACHE[lines] = make_items(lines)
+    day = f"2024-{seed % 12 + 1:02d}-{seed % 28 + 1:02d}"
+    return [dict(item, date=day) for item in items]
+
+# === Порівняння з базовою лінією ===
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base:
+            change = value / base - 1
+            mark = "❌" if change > threshold else "  "
+            print(f"{mark} {name:40s} {value * 1000:10.3f} ms  ({change:+.1%} vs {base * 1000:.3f} ms)")
+            if change > threshold:
+                regressions.append(name)
+        else:
+            print(f"   {name:40s} {value * 1000:10.3f} ms  (немає базової лінії)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки парсерів, категоризатора і бази")
+    parser.add_argument("--sizes", default="tiny,medium,large", help=f"через кому з {', '.join(SIZES)}")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустиме сповільнення, частка")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="записати результати як базову лінію")
+    parser.add_argument("--db", default=BENCH_DATABASE_URL, help="URL сервера Postgres для бенчмарків бази")
+    args = parser.parse_args()
+
+    results = {}
+    results.update(bench_parsers(args.sizes.split(","), args.repeat))
+    results.update(bench_categorize(args.repeat))
+    if args.db:
+        results.update(asyncio.run(bench_db(args.db, args.repeat)))
+    else:
+        print("BENCH_DATABASE_URL не задано — бенчмарки бази пропущено")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Базову лінію збережено у {args.baseline}")
+    elif regressions:
+        print(f"Сповільнення понад {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import random
+from datetime import date, datetime, timedelta
+
+from utils.categories import CATEGORY_RULES
+
+# Розміри чеків, на яких міряються парсери: від крихітного до вивантаження за багато днів
+SIZES = {
+    "tiny": 5,
+    "medium": 150,
+    "large": 2000,
+    "huge": 50000,
+}
+
+NOISE_WORDS = ["ТМ", "Премія", "0,5л", "1кг", "уп.", "ваг.", "Extra", "Lux", "пл/пл", "ж1.5%"]
+
+def product_names(rng, count):
+    # Суміш назв, що потрапляють у різні категорії, і назв, що не збігаються ні з чим
+    keywords = [word for words in CATEGORY_RULES.values() for word in words]
+    names = []
+    for _ in range(count):
+        if rng.random() < 0.8:
+            base = rng.choice(keywords).capitalize()
+        else:
+            base = "Товар " + str(rng.randint(1, 100000))
+        names.append(" ".join([base] + rng.sample(NOISE_WORDS, rng.randint(0, 3))))
+    return names
+
+def escape(text):
+    return text.replace("&", "&amp;").replace('"', "&quot;").replace("<", "&lt;")
+
+def make_atb_receipt(lines, seed=0, receipts=1):
+    # Формат RQ: позиції <P>, знижки <D> на частину з них, мітка часу <TS> у кожному <DAT>
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, 9, 0, 0)
+    per_receipt = max(1, lines // receipts)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><RQ V="1">']
+    for r in range(receipts):
+        parts.append(f'<DAT FN="30001{seed:05d}" TN="ПН 123456" ZN="АТ{r}" DI="{r}" V="1"><C T="0">')
+        for n, name in enumerate(product_names(rng, per_receipt), start=1):
+            price = rng.randint(500, 50000)
+            parts.append(f'<P N="{n}" C="{n}" NM="{escape(name)}" SM="{price}" Q="1" PRC="{price}"/>')
+            if rng.random() < 0.2:
+                parts.append(f'<D NI="{n}" TY="0" SM="{rng.randint(1, price)}"/>')
+        ts = (start + timedelta(hours=r)).strftime("%Y%m%d%H%M%S")
+        parts.append(f'<E N="{per_receipt}" NO="{r}"/></C><TS>{ts}</TS></DAT>')
+    parts.append("</RQ>")
+    return "".join(parts).encode("utf-8")
+
+def make_tax_receipt(lines, seed=0):
+    # Формат CHECK: заголовок з ORDERDATE і рядки CHECKBODY/ROW
+    rng = random.Random(seed)
+    order_date = (date(2024, 1, 1) + timedelta(days=seed % 365)).strftime("%d%m%Y")
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?><CHECK>',
+        f"<CHECKHEAD><ORDERDATE>{order_date}</ORDERDATE><ORDERNUM>{seed}</ORDERNUM></CHECKHEAD>",
+        "<CHECKBODY>",
+    ]
+    for n, name in enumerate(product_names(rng, lines), start=1):
+        parts.append(
+            f'<ROW ROWNUM="{n}"><NAME>{escape(name)}</NAME>'
+            f"<AMOUNT>1</AMOUNT><COST>{rng.randint(5, 500)}.{rng.randint(0, 99):02d}</COST></ROW>"
+        )
+    parts.append("</CHECKBODY></CHECK>")
+    return "".join(parts).encode("utf-8")
+
+def make_items(lines, seed=0):
+    # Готові позиції для бенчмарків бази, без розбору XML
+    rng = random.Random(seed)
+    day = date(2024, 1, 1) + timedelta(days=seed % 365)
+    return [
+        {
+            "name": name,
+            "sum": rng.randint(500, 50000),
+            "discount": 0,
+            "date": day.strftime("%Y-%m-%d"),
+            "category": rng.choice(list(CATEGORY_RULES)).capitalize(),
+        }
+        for name in product_names(rng, lines)
+    ]
@@ -0,0 +1,101 @@
+import time
+import asyncio
+import itertools
+from collections import Counter
+
+from aiohttp import web
+
+# Відповіді бота, після яких обробка оновлення ще не завершена (далі буде підсумок)
+INTERMEDIATE_PREFIXES = ("⏳ Зараз обробляється",)
+# Методи, що повертають повідомлення; решта — просто True
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "sendDocument"}
+
+class FakeBotApi:
+    # Локальна заміна api.telegram.org: приймає виклики бота, запам'ятовує відповіді
+    # по чатах і віддає документи та чеки за посиланнями, які підклав генератор навантаження
+    def __init__(self):
+        self.files = {}
+        self.receipts = {}
+        self.calls = Counter()
+        self.replies = Counter()
+        self.webhook_set = asyncio.Event()
+        self._waiters = {}
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+    def add_file(self, file_id, content):
+        self.files[file_id] = content
+
+    def add_receipt(self, key, content):
+        self.receipts[key] = content
+
+    def expect_reply(self, chat_id):
+        # Майбутнє, яке отримає час першої остаточної відповіді бота в цей чат
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    def forget(self, chat_id):
+        self._waiters.pop(chat_id, None)
+
+    async def start(self, host, port):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        app.router.add_get("/receipts/{key}", self.handle_receipt)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        params = await request.post() if request.can_read_body else {}
+        self.calls[method] += 1
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load", "username": "loadtest_bot"}
+        elif method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.files[file_id]),
+                "file_path": f"documents/{file_id}",
+            }
+        elif method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id"))
+            text = params.get("text") or ""
+            self.replies[chat_id] += 1
+            if not text.startswith(INTERMEDIATE_PREFIXES):
+                future = self._waiters.pop(chat_id, None)
+                if future is not None and not future.done():
+                    future.set_result(time.perf_counter())
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }
+        else:
+            if method == "setWebhook":
+                self.webhook_set.set()
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        if file_id not in self.files:
+            return web.Response(status=404)
+        return web.Response(body=self.files[file_id], content_type="application/xml")
+
+    async def handle_receipt(self, request):
+        key = request.match_info["key"]
+        if key not in self.receipts:
+            return web.Response(status=404)
+        return web.Response(body=self.receipts[key], content_type="application/xml")
@@ -0,0 +1,211 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import secrets
+import tempfile
+import argparse
+from collections import Counter
+
+import aiohttp
+
+from loadtest.fake_api import FakeBotApi
+from loadtest.scenarios import DEFAULT_MIX, ReceiptPool, Scenarios, parse_mix
+
+# Токен лише для шляхів фейкового API: до справжнього Telegram запити не йдуть
+LOADTEST_TOKEN = "123456:loadtest"
+PERCENTILES = (50, 95, 99)
+
+# === Віртуальні користувачі ===
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.webhook = Counter()
+        self.timeouts = Counter()
+        self.errors = Counter()
+
+    def record(self, label, seconds):
+        self.latencies.setdefault(label, []).append(seconds)
+
+async def post_update(session, bot_url, secret, update, stats):
+    # Як Telegram: на 503 чекаємо Retry-After і доставляємо те саме оновлення повторно
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    while True:
+        async with session.post(f"{bot_url}/webhook", json=update, headers=headers) as response:
+            stats.webhook[response.status] += 1
+            if response.status == 503:
+                await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+                continue
+            return response.status == 200
+
+async def virtual_user(chat_id, api, scenarios, mix, session, args, stats, deadline):
+    while time.monotonic() < deadline:
+        for label, update in scenarios.steps(scenarios.choose(mix), chat_id):
+            reply = api.expect_reply(chat_id)
+            started = time.perf_counter()
+            try:
+                if not await post_update(session, args.bot_url, args.secret, update, stats):
+                    stats.errors[label] += 1
+                    api.forget(chat_id)
+                    break
+                finished = await asyncio.wait_for(reply, args.timeout)
+            except asyncio.TimeoutError:
+                stats.timeouts[label] += 1
+                api.forget(chat_id)
+                break
+            except aiohttp.ClientError:
+                stats.errors[label] += 1
+                api.forget(chat_id)
+                break
+            stats.record(label, finished - started)
+        if args.think:
+            await asyncio.sleep(args.think)
+
+# === Звіт ===
+
+def percentile(values, p):
+    # Найближчий ранг: без інтерполяції, як у більшості інструментів навантаження
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))]
+
+def summarize(stats, elapsed, api):
+    rows = {}
+    everything = [value for values in stats.latencies.values() for value in values]
+    for label, values in sorted(stats.latencies.items()) + [("all", everything)]:
+        if not values:
+            continue
+        rows[label] = {
+            "count": len(values),
+            "rps": len(values) / elapsed,
+            **{f"p{p}": percentile(values, p) for p in PERCENTILES},
+            "max": max(values),
+        }
+    return {
+        "elapsed": elapsed,
+        "steps": rows,
+        "webhook": {str(status): count for status, count in sorted(stats.webhook.items())},
+        "timeouts": dict(stats.timeouts),
+        "errors": dict(stats.errors),
+        "api_calls": dict(api.calls),
+        "replies": sum(api.replies.values()),
+    }
+
+def print_report(report):
+    print(f"⏱️ Тривалість: {report['elapsed']:.1f} с, відповідей бота: {report['replies']}")
+    print(f"{'крок':<24}{'к-сть':>8}{'кроків/с':>10}" + "".join(f"{'p' + str(p) + ', мс':>11}" for p in PERCENTILES) + f"{'max, мс':>11}")
+    for label, row in report["steps"].items():
+        line = f"{label:<24}{row['count']:>8}{row['rps']:>10.1f}"
+        line += "".join(f"{row[f'p{p}'] * 1000:>11.0f}" for p in PERCENTILES)
+        print(line + f"{row['max'] * 1000:>11.0f}")
+    print(f"🌐 Вебхук: {report['webhook']}")
+    if report["timeouts"]:
+        print(f"⌛ Без відповіді: {report['timeouts']}")
+    if report["errors"]:
+        print(f"❌ Помилки: {report['errors']}")
+
+# === Запуск бота ===
+
+async def spawn_bot(args):
+    # Бот у окремому процесі з тими ж налаштуваннями, що й у продакшені, але з фейковим Bot API
+    env = dict(
+        os.environ,
+        BOT_TOKEN=LOADTEST_TOKEN,
+        TELEGRAM_API_URL=args.api_url,
+        WEBHOOK_URL=args.bot_url,
+        WEBHOOK_SECRET=args.secret,
+    )
+    port = args.bot_url.rsplit(":", 1)[-1].split("/")[0]
+    with open(args.bot_log, "wb") as log:
+        return await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", port, "--log-level", "warning",
+            env=env, stdout=log, stderr=asyncio.subprocess.STDOUT,
+        )
+
+async def stop_bot(process):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), 30)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+async def wait_for_bot(args, api, process):
+    # Запущений нами бот готовий, коли викликав setWebhook у фейкового API і вже приймає
+    # HTTP-запити; бот, запущений окремо (з TELEGRAM_API_URL на цей API), — коли відповідає /health
+    deadline = time.monotonic() + args.startup_timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process and process.returncode is not None:
+                break
+            if api.webhook_set.is_set() or not process:
+                try:
+                    async with session.get(f"{args.bot_url}/health") as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Бот не запустився — перевірте DATABASE_URL і журнал {args.bot_log}")
+
+async def run(args):
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+    api = FakeBotApi()
+    pool = ReceiptPool(api, args.receipts, args.lines, args.seed)
+    await api.start("127.0.0.1", args.api_port)
+    process = await spawn_bot(args) if args.spawn_bot else None
+    try:
+        await wait_for_bot(args, api, process)
+        stats = Stats()
+        scenarios = Scenarios(api, pool, args.api_url, args.seed)
+        connector = aiohttp.TCPConnector(limit=args.chats)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            started = time.monotonic()
+            deadline = started + args.duration
+            await asyncio.gather(*(
+                virtual_user(args.first_chat + n, api, scenarios, mix, session, args, stats, deadline)
+                for n in range(args.chats)
+            ))
+            elapsed = time.monotonic() - started
+        return summarize(stats, elapsed, api)
+    finally:
+        if process:
+            await stop_bot(process)
+        await api.stop()
+
+def main():
+    # python -m loadtest.run --spawn-bot --chats 50 --duration 120   (DATABASE_URL — тестова база)
+    parser = argparse.ArgumentParser(description="Навантажувальний тест бота з фейковим Bot API")
+    parser.add_argument("--bot-url", default="http://127.0.0.1:8443", help="адреса бота (FastAPI)")
+    parser.add_argument("--api-port", type=int, default=8081, help="порт фейкового Bot API")
+    parser.add_argument("--spawn-bot", action="store_true", help="запустити бота (uvicorn main:app) самому")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET"), help="WEBHOOK_SECRET бота")
+    parser.add_argument("--chats", type=int, default=20, help="кількість віртуальних користувачів")
+    parser.add_argument("--first-chat", type=int, default=900000000, help="id першого віртуального чату")
+    parser.add_argument("--duration", type=float, default=60, help="тривалість у секундах")
+    parser.add_argument("--think", type=float, default=0.2, help="пауза між сценаріями одного користувача")
+    parser.add_argument("--timeout", type=float, default=30, help="скільки чекати відповіді бота")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="скільки чекати запуску бота")
+    parser.add_argument("--bot-log", default=os.path.join(tempfile.gettempdir(), "loadtest-bot.log"), help="журнал запущеного бота")
+    parser.add_argument("--mix", help="ваги сценаріїв, напр. xml=3,url=2,manual=2,report=3")
+    parser.add_argument("--receipts", type=int, default=200, help="скільки різних чеків згенерувати")
+    parser.add_argument("--lines", type=int, default=30, help="позицій у чеку")
+    parser.add_argument("--seed", type=int, default=int(time.time()))
+    parser.add_argument("--json", help="записати звіт у файл")
+    args = parser.parse_args()
+    args.bot_url = args.bot_url.rstrip("/")
+    args.api_url = f"http://127.0.0.1:{args.api_port}"
+    if args.spawn_bot and not args.secret:
+        args.secret = secrets.token_urlsafe(24)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import time
+import random
+import itertools
+
+from benchmarks.synthetic import make_atb_receipt, make_tax_receipt
+
+# Суміш сценаріїв за замовчуванням: вага кожного серед дій віртуальних користувачів
+DEFAULT_MIX = {"xml": 3, "url": 2, "manual": 2, "report": 3}
+REPORT_COMMANDS = ["/report_day", "/report_week", "/report_mounth", "/report_trend"]
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+def parse_mix(text):
+    # "xml=3,url=1" -> {"xml": 3, "url": 1}
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Невідомий сценарій: {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+def message_update(chat_id, text=None, document=None):
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": "Load"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if document is not None:
+        message["document"] = document
+    return {"update_id": next(_update_ids), "message": message}
+
+class ReceiptPool:
+    # Чеки генеруються заздалегідь, щоб генератор навантаження не ділив процесор з ботом.
+    # Насіння залежить від запуску: повторний запуск не впирається лише в дублікати.
+    def __init__(self, api, size, lines, seed):
+        self.keys = []
+        for n in range(size):
+            key = f"r{seed}-{n}"
+            make = make_atb_receipt if n % 2 == 0 else make_tax_receipt
+            content = make(lines, seed=seed + n)
+            api.add_file(key, content)
+            api.add_receipt(key, content)
+            self.keys.append(key)
+
+    def pick(self, rng):
+        return rng.choice(self.keys)
+
+class Scenarios:
+    def __init__(self, api, pool, api_url, seed):
+        self.api = api
+        self.pool = pool
+        self.api_url = api_url.rstrip("/")
+        self.rng = random.Random(seed)
+
+    def steps(self, name, chat_id):
+        # Список (мітка кроку, оновлення); кроки одного сценарію виконуються по черзі
+        if name == "xml":
+            key = self.pool.pick(self.rng)
+            document = {
+                "file_id": key,
+                "file_unique_id": key,
+                "file_name": f"{key}.xml",
+                "mime_type": "application/xml",
+                "file_size": len(self.api.files[key]),
+            }
+            return [("xml", message_update(chat_id, document=document))]
+        if name == "url":
+            key = self.pool.pick(self.rng)
+            return [("url", message_update(chat_id, text=f"{self.api_url}/receipts/{key}"))]
+        if name == "manual":
+            price = f"{self.rng.randint(1, 500)}.{self.rng.randint(0, 99):02d}"
+            return [
+                ("manual:start", message_update(chat_id, text="/manual")),
+                ("manual:name", message_update(chat_id, text=f"Хліб {self.rng.randint(1, 1000)}")),
+                ("manual:price", message_update(chat_id, text=price)),
+            ]
+        command = self.rng.choice(REPORT_COMMANDS)
+        return [(f"report:{command[1:]}", message_update(chat_id, text=command))]
+
+    def choose(self, mix):
+        names = list(mix)
+        return self.rng.choices(names, weights=[mix[name] for name in names])[0]
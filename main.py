@@ -1,9 +1,18 @@
 import os
+import math
+import time
+import asyncio
 import logging
+import html
+import tempfile
+from io import BytesIO
+import orjson
 from datetime import datetime
-from fastapi import FastAPI, Request, Response
+from typing import Optional
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -11,16 +20,60 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
+    CallbackQueryHandler,
 )
 
-from parsers.xml_parser import parse_xml_file, parse_xml_string, parse_xml_url
-from utils.db import init_db, save_items_to_db, get_report, get_debug_info, delete_check_by_id, delete_item_by_id
-from utils.categories import categorize
+from parsers.xml_parser import parse_xml_file, parse_xml_string, parse_xml_many, split_checks
+from utils.db import ITEM_SUM_MAX, init_db, close_db, check_db, save_items_to_db, save_checks_to_db, get_report, get_debug_info, delete_check_by_id, delete_item_by_id, get_check_page, get_check_total, get_trend, get_item, set_category_override, apply_cached_overrides
+from utils.categories import categorize, get_category_names
+from utils.documents import DOCUMENT_MEMORY_LIMIT, open_document
+from utils.recategorize import start_recategorizer, stop_recategorizer
+from utils.export import EXPORT_FORMATS, EXPORT_TOKEN, export_header, export_items
+from utils.report_cache import parse_date
+from utils.archives import ARCHIVE_EXTENSIONS, ArchiveError, read_archive
+from utils.fetcher import init_http, close_http, fetch_receipts
+from utils.workers import init_workers, close_workers, run_parse, get_workers_stats, WorkerPoolBusy, PARSE_WORKERS
+from utils.metrics import timed_handler, render_metrics, UPDATE_QUEUE_DEPTH, JOURNAL_PENDING, WEBHOOK_REQUESTS, ERRORS
+from utils.scheduler import PerChatUpdateProcessor
+from utils.webhook import SECRET_HEADER, RecentUpdates, check_secret_token
+from utils.persistence import DbPersistence, apply_conversation_state
+from utils.journal import init_journal, close_journal, journal_enabled, append_checks, get_journal_stats, get_pending
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Інша адреса Bot API (локальний сервер Bot API або фейковий API з loadtest/); за замовчуванням — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Секрет, який Telegram надсилає в заголовку X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ і -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Скільки оновлень обробляється одночасно (оновлення одного чату — завжди по черзі)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+# Скільки прийнятих оновлень може чекати на обробку; понад це вебхук відповідає 503
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Скільки останніх update_id пам'ятати для відсіювання повторних доставок
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+# Скільки чеків з архіву розбирається паралельно і зберігається однією транзакцією
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "200"))
+# Як часто (секунди) оновлювати повідомлення з прогресом імпорту
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", "3"))
+# Позицій чека на одній сторінці; назви обрізаються, щоб сторінка завжди вміщалась у повідомлення
+SUMMARY_PAGE_SIZE = int(os.getenv("SUMMARY_PAGE_SIZE", "20"))
+ITEM_NAME_MAX = 120
+# Якщо в одному документі більше чеків, замість підсумку на кожен надсилається один загальний
+SUMMARY_MAX_CHECKS = 5
+# Тренд: відрізків за замовчуванням і максимум, рядків-категорій у таблиці (решта — разом)
+TREND_DEFAULT_BUCKETS = {"day": 7, "week": 6}
+TREND_MAX_BUCKETS = 8
+TREND_MAX_CATEGORIES = 8
+# Рядків-категорій у звіті (решта — разом): категорії користувачів не обмежені кількістю,
+# а звіт має вміститися в одне повідомлення (CATEGORY_NAME_MAX символів на назву)
+REPORT_MAX_CATEGORIES = 40
+# З журналом прийом чеків не повинен чекати на базу: стан діалогів читається з коротким
+# тайм-аутом, а після невдачі база не опитується STATE_RETRY_INTERVAL секунд
+STATE_LOAD_TIMEOUT = float(os.getenv("STATE_LOAD_TIMEOUT", "1"))
+STATE_RETRY_INTERVAL = float(os.getenv("STATE_RETRY_INTERVAL", "5"))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,9 +83,23 @@ DELETE_CHECK_ID = "DELETE_CHECK"
 DELETE_ITEM_ID = "DELETE_ITEM"
 REPORT_ALL_FROM = "REPORT_ALL_FROM"
 REPORT_ALL_TO = "REPORT_ALL_TO"
+RECATEGORIZE_ITEM = "RECATEGORIZE_ITEM"
+RECATEGORIZE_CATEGORY = "RECATEGORIZE_CATEGORY"
+CATEGORY_NAME_MAX = 50
 
 info_keyboard = ReplyKeyboardMarkup([["💡 Info"]], resize_keyboard=True)
 
+FETCH_ERRORS = {
+    "http_status": "❌ Сервер повернув помилку",
+    "too_large": "❌ Чек завеликий для завантаження",
+    "unsupported_format": "❌ Невідомий формат чека",
+    "invalid_xml": "❌ Отримано некоректний XML",
+    "invalid_receipt": "❌ Чек містить некоректні суми",
+    "invalid_url": "❌ Некоректне посилання",
+    "timeout": "❌ Сервер не відповів вчасно",
+    "network": "❌ Не вдалося з'єднатися з сервером",
+}
+
 # === Команды ===
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -44,10 +111,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/report_week — звіт за тиждень\n"
         "/report_mounth — звіт за місяць\n"
         "/report_all — звіт за вибраний період\n"
+        "/report_trend [day|week] [N] — динаміка витрат по категоріях\n"
         "/debug — технічна інформація\n"
         "/manual — додати товар вручну\n"
         "/delete_check — видалити чек\n"
-        "/delete_item — видалити товар\n\n"
+        "/delete_item — видалити товар\n"
+        "/recategorize — виправити категорію товару\n"
+        "/export [з] [по] [csv|jsonl] — вивантажити товари у файл\n\n"
         "Натисніть кнопку «💡 Info», щоб побачити список команд."
     )
     await update.message.reply_text(msg, reply_markup=info_keyboard)
@@ -57,14 +127,15 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # === Обработка XML ===
 
+@timed_handler
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    file = await update.message.document.get_file()
-    file_path = f"/tmp/{file.file_id}.xml"
-    await file.download_to_drive(file_path)
-    items = parse_xml_file(file_path)
-    check_id, item_ids = save_items_to_db(items)
-    await send_summary(update, items, check_id, item_ids)
+    async with open_document(update.message.document) as source:
+        items = await parse_in_worker(update, parse_xml_file, source)
+    if items is None:
+        return
+    await store_checks(update, [items])
 
+@timed_handler
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     # allow universal info in manual mode
@@ -75,38 +146,251 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ Продовжіть введення назви або ціни товару, або введіть /cancel.")
         return
     if text.lower().startswith("http"):
-        items = parse_xml_url(text)
+        await handle_urls(update, text.split())
+        return
     elif "<?xml" in text:
-        items = parse_xml_string(text)
+        items = await parse_in_worker(update, parse_xml_string, text)
+        if items is None:
+            return
     elif text == "💡 Info":
         await info(update, context)
         return
     else:
         await update.message.reply_text("❌ Це не схоже на XML або URL.\nСпробуйте ще.")
         return
-    check_id, item_ids = save_items_to_db(items)
-    await send_summary(update, items, check_id, item_ids)
+    await store_checks(update, [items])
+
+@timed_handler
+async def handle_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # ZIP/tar з багатьма чеками: розбір пачками паралельно у воркерах, збереження
+    # однією транзакцією на пачку, прогрес в одному повідомленні і один підсумок у кінці
+    async with open_document(update.message.document) as source:
+        if isinstance(source, BytesIO):
+            # Окремий BytesIO у кожного читача: файловий об'єкт не можна ділити між потоками
+            source = source.getvalue()
+        try:
+            files = await parse_in_worker(update, read_archive, source)
+        except ArchiveError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+    if files is None:
+        return
+    if not files:
+        await update.message.reply_text("❌ В архіві немає XML-файлів.")
+        return
+
+    progress = await update.message.reply_text(f"📦 Імпорт: 0/{len(files)} файлів…")
+    last_progress = time.monotonic()
+    stats = {"new": 0, "duplicate": 0, "items": 0, "total": 0, "dates": set()}
+    failed = []
+    done = 0
+    for start in range(0, len(files), IMPORT_BATCH_SIZE):
+        batch = files[start:start + IMPORT_BATCH_SIZE]
+        step = -(-len(batch) // PARSE_WORKERS)
+        chunks = [batch[i:i + step] for i in range(0, len(batch), step)]
+        try:
+            parsed = await asyncio.gather(*(
+                run_parse(parse_xml_many, [content for _, content in chunk]) for chunk in chunks
+            ))
+        except WorkerPoolBusy:
+            await update.message.reply_text(
+                f"⏳ Бот перевантажений, імпорт зупинено після {done} файлів. "
+                "Надішліть архів трохи пізніше — вже додані чеки не задвояться."
+            )
+            return
+        checks = []
+        for chunk, results in zip(chunks, parsed):
+            for (name, _), items in zip(chunk, results):
+                if items:
+                    checks.extend(split_checks(items))
+                else:
+                    failed.append(name)
+        for items, (_, _, duplicate) in zip(checks, await save_checks_to_db(update.effective_user.id, checks)):
+            if duplicate:
+                stats["duplicate"] += 1
+                continue
+            stats["new"] += 1
+            stats["items"] += len(items)
+            stats["total"] += sum(item["sum"] for item in items)
+            stats["dates"].update(item["date"] for item in items)
+        done += len(batch)
+        if done < len(files) and time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+            await progress.edit_text(f"📦 Імпорт: {done}/{len(files)} файлів…")
+            last_progress = time.monotonic()
+
+    text = f"📦 Імпорт завершено: {len(files)} файлів\n"
+    text += f"✅ Нових чеків: {stats['new']} — {stats['items']} товарів на {stats['total'] / 100:.2f} грн\n"
+    if stats["dates"]:
+        text += f"📅 Період: {min(stats['dates'])} — {max(stats['dates'])}\n"
+    if stats["duplicate"]:
+        text += f"ℹ️ Уже були додані раніше: {stats['duplicate']}\n"
+    if failed:
+        text += f"❌ Не розпізнано: {len(failed)}\n"
+        text += "".join(f"• {name}\n" for name in failed[:10])
+        if len(failed) > 10:
+            text += f"… і ще {len(failed) - 10}\n"
+    await progress.edit_text(text)
+
+async def parse_in_worker(update, fn, *args):
+    # Розбір і категоризація виконуються поза циклом подій; при перевантаженні
+    # повертає None, попередньо повідомивши користувача
+    async def notify_queued():
+        await update.message.reply_text("⏳ Зараз обробляється багато чеків, ваш чек у черзі…")
+    try:
+        return await run_parse(fn, *args, on_queued=notify_queued)
+    except WorkerPoolBusy:
+        await update.message.reply_text("⏳ Бот перевантажений, надішліть чек трохи пізніше.")
+        return None
+
+async def handle_urls(update, urls):
+    # Кілька посилань завантажуються паралельно і зберігаються однією транзакцією
+    results = await fetch_receipts(urls)
+    fetched = []
+    for result in results:
+        if result.ok:
+            fetched.append(result)
+            continue
+        reason = FETCH_ERRORS.get(result.error, "❌ Не вдалося завантажити чек")
+        if result.status:
+            reason += f" (HTTP {result.status})"
+        await update.message.reply_text(f"{reason}:\n{result.url}")
+    await store_checks(update, [result.items for result in fetched])
 
-async def send_summary(update, items, check_id, item_ids):
+async def store_checks(update, checks):
+    # Без журналу чеки одразу зберігаються в базу. З журналом — лише записуються на диск,
+    # а в базу їх пачками переносить фоновий процес, тож відповідь не чекає на базу.
+    # Документ із кількома чеками (різні відбитки) зберігається як кілька чеків.
+    checks = [check for items in checks for check in (split_checks(items) or [items])]
+    if journal_enabled():
+        found = [items for items in checks if items]
+        if found:
+            try:
+                await append_checks(update.effective_user.id, found)
+            except ValueError as e:
+                await update.message.reply_text(f"❌ Чек не прийнято: {e}")
+                return
+            await resolve_reply_categories(update.effective_user.id, found)
+        if len(found) > SUMMARY_MAX_CHECKS:
+            await update.message.reply_text(
+                f"📥 Прийнято чеків: {len(found)} — {count_items(found)}, у звітах вони з'являться за кілька секунд."
+            )
+            return
+        for items in checks:
+            await send_accepted(update, items)
+        return
+    saved = await save_checks_to_db(update.effective_user.id, checks)
+    if len(checks) > SUMMARY_MAX_CHECKS:
+        new = [items for items, (_, _, duplicate) in zip(checks, saved) if not duplicate]
+        text = f"✅ Нових чеків: {len(new)} — {count_items(new)}"
+        if len(new) < len(checks):
+            text += f"\nℹ️ Уже були додані раніше: {len(checks) - len(new)}"
+        await update.message.reply_text(text)
+        return
+    for items, (check_id, item_ids, duplicate) in zip(checks, saved):
+        await send_summary(update, items, check_id, item_ids, duplicate)
+
+def count_items(checks):
+    items = [item for items in checks for item in items]
+    return f"{len(items)} товарів на {sum(item['sum'] for item in items) / 100:.2f} грн"
+
+async def resolve_reply_categories(user_id, checks):
+    # Чеки з журналу ще не пройшли через базу, тож виправлення категорій користувача
+    # підставляються для відповіді тут: з кешу, а решта — з бази, якщо вона відповідає
+    # (той самий тайм-аут і пауза, що й для стану діалогів)
+    global state_retry_at
+    timeout = STATE_LOAD_TIMEOUT if time.monotonic() >= state_retry_at else None
+    try:
+        await apply_cached_overrides(user_id, checks, timeout)
+    except Exception as e:
+        state_retry_at = time.monotonic() + STATE_RETRY_INTERVAL
+        logger.warning(f"⚠️ Виправлення категорій недоступні, показуємо автоматичні: {e}")
+
+async def send_accepted(update, items):
+    # ID чека і товарів з'являться лише після запису в базу, тому без них і без кнопок
     if not items:
         await update.message.reply_text("❌ Не вдалося знайти товари в цьому чеку.")
         return
-    text = f"✅ Додано чек #{check_id}:\n"
-    total = 0
-    for item, item_id in zip(items, item_ids):
-        text += f"• ID {item_id} — {item['name']} ({item['category']}) — {item['sum'] / 100:.2f} грн\n"
-        total += item['sum']
-    text += f"\n💰 Всього: {total / 100:.2f} грн"
-    await update.message.reply_text(text)
+    lines = ["📥 Чек прийнято, у звітах він з'явиться за кілька секунд:"]
+    lines.extend(
+        f"• {item['name'][:ITEM_NAME_MAX]} ({item['category']}) — {item['sum'] / 100:.2f} грн"
+        for item in items[:SUMMARY_PAGE_SIZE]
+    )
+    if len(items) > SUMMARY_PAGE_SIZE:
+        lines.append(f"… і ще {len(items) - SUMMARY_PAGE_SIZE} позицій")
+    lines.append("")
+    lines.append(f"💰 Всього: {sum(item['sum'] for item in items) / 100:.2f} грн")
+    await update.message.reply_text("\n".join(lines))
+
+async def send_summary(update, items, check_id, item_ids, duplicate=False):
+    # Для нового чека перша сторінка будується з уже розібраних позицій; наступні кнопки
+    # читають з бази. Дублікат показується з бази: частину його товарів могли видалити.
+    if not items:
+        await update.message.reply_text("❌ Не вдалося знайти товари в цьому чеку.")
+        return
+    if duplicate:
+        header = f"ℹ️ Цей чек уже додано раніше як #{check_id}:"
+        count, total = await get_check_total(update.effective_user.id, check_id)
+        if not count:
+            await update.message.reply_text(f"ℹ️ Цей чек уже додано раніше як #{check_id}, але всі його товари видалено.")
+            return
+        rows, more = await get_check_page(update.effective_user.id, check_id, SUMMARY_PAGE_SIZE)
+    else:
+        header = f"✅ Додано чек #{check_id}:"
+        count, total = len(items), sum(item["sum"] for item in items)
+        rows = [dict(item, id=item_id) for item, item_id in zip(items[:SUMMARY_PAGE_SIZE], item_ids)]
+        more = count > SUMMARY_PAGE_SIZE
+    text, markup = render_check_page(header, check_id, count, total, 0, rows, more)
+    await update.message.reply_text(text, reply_markup=markup)
+
+def render_check_page(header, check_id, count, total, offset, rows, more):
+    lines = [header]
+    lines.extend(
+        f"• ID {row['id']} — {row['name'][:ITEM_NAME_MAX]} ({row['category']}) — {row['sum'] / 100:.2f} грн"
+        for row in rows
+    )
+    lines.append("")
+    if count > len(rows):
+        lines.append(f"Позиції {offset + 1}–{offset + len(rows)} з {count}")
+    lines.append(f"💰 Всього: {total / 100:.2f} грн")
+    # У callback_data — усе, що потрібно для сусідньої сторінки, без повторного підрахунку чека
+    buttons = []
+    if rows and offset > 0:
+        buttons.append(InlineKeyboardButton(
+            "◀️", callback_data=f"page:{check_id}:{count}:{total}:{offset - SUMMARY_PAGE_SIZE}:b{rows[0]['id']}"
+        ))
+    if rows and more:
+        buttons.append(InlineKeyboardButton(
+            "▶️", callback_data=f"page:{check_id}:{count}:{total}:{offset + len(rows)}:a{rows[-1]['id']}"
+        ))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+@timed_handler
+async def check_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, check_id, count, total, offset, cursor = query.data.split(":")
+    check_id, count, total, offset = int(check_id), int(count), int(total), max(int(offset), 0)
+    if cursor[0] == "a":
+        rows, more = await get_check_page(update.effective_user.id, check_id, SUMMARY_PAGE_SIZE, after=int(cursor[1:]))
+    else:
+        rows, _ = await get_check_page(update.effective_user.id, check_id, SUMMARY_PAGE_SIZE, before=int(cursor[1:]))
+        more = True
+    if not rows:
+        await query.edit_message_text(f"❌ Позиції чека #{check_id} не знайдено — можливо, його видалено.")
+        return
+    text, markup = render_check_page(f"🧾 Чек #{check_id}:", check_id, count, total, offset, rows, more)
+    await query.edit_message_text(text, reply_markup=markup)
 
 # === Вручную ===
 
+@timed_handler
 async def manual_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     context.user_data["manual_in_progress"] = True
     await update.message.reply_text("Введіть назву товару:")
     return WAITING_NAME
 
+@timed_handler
 async def manual_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text.strip()
     if not name:
@@ -116,6 +400,7 @@ async def manual_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введіть суму в грн (наприклад, 23.50):")
     return WAITING_PRICE
 
+@timed_handler
 async def manual_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     try:
@@ -123,6 +408,10 @@ async def manual_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Невірна сума. Спробуйте ще:")
         return WAITING_PRICE
+    # Сума в копійках має вміститися в items."sum"
+    if not math.isfinite(price) or abs(int(price * 100)) > ITEM_SUM_MAX:
+        await update.message.reply_text("❌ Невірна сума. Спробуйте ще:")
+        return WAITING_PRICE
     name = context.user_data['manual_data']['name']
     category = categorize(name)
     now = datetime.now()
@@ -132,8 +421,14 @@ async def manual_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "category": category,
         "sum": int(price * 100)
     }
-    check_id, item_ids = save_items_to_db([item])
-    await update.message.reply_text(f"✅ Додано: ID {item_ids[0]} — {name} ({category}) — {price:.2f} грн")
+    if journal_enabled():
+        await append_checks(update.effective_user.id, [[item]])
+        await resolve_reply_categories(update.effective_user.id, [[item]])
+        await update.message.reply_text(f"✅ Додано: {name} ({item['category']}) — {price:.2f} грн")
+    else:
+        check_id, item_ids, _ = await save_items_to_db(update.effective_user.id, [item])
+        # Категорію могло замінити виправлення користувача для цієї назви
+        await update.message.reply_text(f"✅ Додано: ID {item_ids[0]} — {name} ({item['category']}) — {price:.2f} грн")
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -150,56 +445,116 @@ async def universal_command_exit(update: Update, context: ContextTypes.DEFAULT_T
 
 # === Удаление ===
 
+@timed_handler
 async def delete_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введіть ID чеку для видалення:")
     return DELETE_CHECK_ID
 
+@timed_handler
 async def delete_check_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     check_id = update.message.text.strip()
-    success = delete_check_by_id(check_id)
+    success = await delete_check_by_id(update.effective_user.id, check_id)
     msg = "✅ Чек видалено." if success else "❌ Не знайдено чек."
     await update.message.reply_text(msg)
     return ConversationHandler.END
 
+@timed_handler
 async def delete_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введіть ID товару для видалення:")
     return DELETE_ITEM_ID
 
+@timed_handler
 async def delete_item_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     item_id = update.message.text.strip()
-    success = delete_item_by_id(item_id)
+    success = await delete_item_by_id(update.effective_user.id, item_id)
     msg = "✅ Товар видалено." if success else "❌ Не знайдено товар."
     await update.message.reply_text(msg)
     return ConversationHandler.END
 
+# === Виправлення категорії ===
+
+@timed_handler
+async def recategorize(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Введіть ID товару, категорію якого треба виправити:")
+    return RECATEGORIZE_ITEM
+
+@timed_handler
+async def recategorize_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    item = await get_item(update.effective_user.id, int(text)) if text.isdigit() else None
+    if item is None:
+        await update.message.reply_text("❌ Не знайдено товар. Введіть ID ще раз або /cancel:")
+        return RECATEGORIZE_ITEM
+    context.user_data["recategorize_item"] = item["id"]
+    names = get_category_names()
+    keyboard = ReplyKeyboardMarkup(
+        [names[i:i + 2] for i in range(0, len(names), 2)], resize_keyboard=True, one_time_keyboard=True
+    )
+    await update.message.reply_text(
+        f"{item['name']} — зараз «{item['category']}».\nОберіть або введіть нову категорію:",
+        reply_markup=keyboard,
+    )
+    return RECATEGORIZE_CATEGORY
+
+@timed_handler
+async def recategorize_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()[:CATEGORY_NAME_MAX]
+    if not text:
+        await update.message.reply_text("❗ Введіть назву категорії:")
+        return RECATEGORIZE_CATEGORY
+    # Відома категорія, введена в іншому регістрі, зводиться до її звичного написання
+    known = {name.lower(): name for name in get_category_names()}
+    category = known.get(text.lower(), text)
+    item_id = context.user_data.pop("recategorize_item", None)
+    moved = await set_category_override(update.effective_user.id, item_id, category) if item_id else None
+    if moved is None:
+        await update.message.reply_text("❌ Товар уже видалено.", reply_markup=info_keyboard)
+    else:
+        await update.message.reply_text(
+            f"✅ Категорію «{category}» запам'ятовано для цієї назви. Виправлено товарів: {moved}.",
+            reply_markup=info_keyboard,
+        )
+    return ConversationHandler.END
+
 # === Отчеты ===
 
+@timed_handler
 async def report_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = get_report("day")
+    data = await get_report(update.effective_user.id, "day")
     await send_report(update, data, "за сьогодні")
 
+@timed_handler
 async def report_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = get_report("week")
+    data = await get_report(update.effective_user.id, "week")
     await send_report(update, data, "за тиждень")
 
+@timed_handler
 async def report_mounth(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = get_report("month")
+    data = await get_report(update.effective_user.id, "month")
     await send_report(update, data, "за місяць")
 
+@timed_handler
 async def report_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введіть дату початку у форматі YYYY-MM-DD:")
     return REPORT_ALL_FROM
 
+@timed_handler
 async def report_all_from(update: Update, context: ContextTypes.DEFAULT_TYPE):
     from_date = update.message.text.strip()
     context.user_data['from_date'] = from_date
     await update.message.reply_text("Введіть дату кінця у форматі YYYY-MM-DD:")
     return REPORT_ALL_TO
 
+@timed_handler
 async def report_all_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
     to_date = update.message.text.strip()
     from_date = context.user_data.get('from_date')
-    data = get_report("custom", from_date=from_date, to_date=to_date)
+    try:
+        data = await get_report(update.effective_user.id, "custom", from_date=from_date, to_date=to_date)
+    except ValueError:
+        await update.message.reply_text("❌ Невірний формат дати. Використовуйте YYYY-MM-DD.")
+        context.user_data.clear()
+        return ConversationHandler.END
     await send_report(update, data, f"з {from_date} по {to_date}")
     context.user_data.clear()
     return ConversationHandler.END
@@ -208,33 +563,174 @@ async def send_report(update, data, period_desc):
     if not data:
         await update.message.reply_text(f"ℹ️ За період {period_desc} даних немає.")
         return
-    text = f"📊 Звіт {period_desc}:\n"
-    total = 0
-    for cat, amount in data.items():
-        text += f"• {cat}: {amount / 100:.2f} грн\n"
-        total += amount
-    text += f"\n💰 Всього: {total / 100:.2f} грн"
-    await update.message.reply_text(text)
+    # Найбільші категорії зверху; решта одним рядком, щоб підсумок лишався повним
+    ranked = sorted(data.items(), key=lambda row: row[1], reverse=True)
+    shown, rest = ranked[:REPORT_MAX_CATEGORIES], ranked[REPORT_MAX_CATEGORIES:]
+    lines = [f"📊 Звіт {period_desc}:"]
+    lines.extend(f"• {cat[:CATEGORY_NAME_MAX]}: {amount / 100:.2f} грн" for cat, amount in shown)
+    if rest:
+        lines.append(f"• Решта ({len(rest)} категорій): {sum(amount for _, amount in rest) / 100:.2f} грн")
+    lines.append("")
+    lines.append(f"💰 Всього: {sum(data.values()) / 100:.2f} грн")
+    await update.message.reply_text("\n".join(lines))
+
+@timed_handler
+async def report_trend(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = [arg.lower() for arg in context.args or []]
+    unit = args.pop(0) if args and args[0] in TREND_DEFAULT_BUCKETS else "week"
+    try:
+        buckets = int(args[0]) if args else TREND_DEFAULT_BUCKETS[unit]
+    except ValueError:
+        buckets = 0
+    if not 2 <= buckets <= TREND_MAX_BUCKETS or len(args) > 1:
+        await update.message.reply_text(f"❌ Використання: /report_trend [day|week] [2–{TREND_MAX_BUCKETS}]")
+        return
+    rows = await get_trend(update.effective_user.id, unit, buckets)
+    if not rows:
+        await update.message.reply_text("ℹ️ За цей період даних немає.")
+        return
+    title = "по днях" if unit == "day" else "по тижнях"
+    await update.message.reply_text(
+        f"📈 Динаміка {title}, грн:\n<pre>{html.escape(render_trend(rows))}</pre>",
+        parse_mode="HTML",
+    )
+
+def render_trend(rows):
+    # Рядки — категорії (найбільші за весь період зверху), стовпці — відрізки,
+    # останній стовпець — зміна останнього відрізка до попереднього
+    buckets = sorted({row["bucket"] for row in rows})
+    totals = {}
+    deltas = {}
+    for row in rows:
+        totals.setdefault(row["category"], {})[row["bucket"]] = row["total"]
+        if row["bucket"] == buckets[-1]:
+            deltas[row["category"]] = row["delta"] or 0
+    ranked = sorted(totals, key=lambda cat: sum(totals[cat].values()), reverse=True)
+    shown, rest = ranked[:TREND_MAX_CATEGORIES], ranked[TREND_MAX_CATEGORIES:]
+
+    def merged(categories):
+        return {b: sum(totals[cat].get(b, 0) for cat in categories) for b in buckets}
+
+    table = [(cat, totals[cat], deltas[cat]) for cat in shown]
+    if rest:
+        table.append(("Решта", merged(rest), sum(deltas[cat] for cat in rest)))
+    all_totals = merged(ranked)
+    table.append(("Всього", all_totals, sum(deltas.values())))
+
+    name_width = min(max(len(name) for name, _, _ in table), 12)
+    lines = [" ".join(
+        [f"{'':{name_width}}"] + [f"{b:%d.%m}".rjust(6) for b in buckets] + ["Δ".rjust(6)]
+    )]
+    for name, values, delta in table:
+        lines.append(" ".join(
+            [f"{name[:name_width]:{name_width}}"]
+            + [f"{values[b] / 100:6.0f}" for b in buckets]
+            + [f"{delta / 100:+6.0f}"]
+        ))
+    return "\n".join(lines)
+
+# === Экспорт ===
+
+def parse_export_args(args):
+    # /export [YYYY-MM-DD [YYYY-MM-DD]] [csv|jsonl]
+    args = list(args)
+    fmt = args.pop() if args and args[-1].lower() in EXPORT_FORMATS else "csv"
+    if len(args) > 2:
+        raise ValueError("too many arguments")
+    dates = [parse_date(arg) for arg in args]
+    start = dates[0] if dates else None
+    end = dates[1] if len(dates) > 1 else None
+    return start, end, fmt.lower()
+
+@timed_handler
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        start, end, fmt = parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text("❌ Використання: /export [YYYY-MM-DD] [YYYY-MM-DD] [csv|jsonl]")
+        return
+    # Telegram приймає документ цілим, тож файл збирається в буфері, який понад
+    # DOCUMENT_MEMORY_LIMIT переходить на диск; рядки з бази читаються пачками
+    with tempfile.SpooledTemporaryFile(max_size=DOCUMENT_MEMORY_LIMIT) as out:
+        async for chunk in export_items(update.effective_user.id, start, end, fmt):
+            out.write(chunk)
+        if out.tell() == len(export_header(fmt)):
+            await update.message.reply_text("ℹ️ За цей період товарів немає.")
+            return
+        out.seek(0)
+        await update.message.reply_document(out, filename=f"items.{fmt}")
 
 # === Debug ===
 
+@timed_handler
 async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    info = get_debug_info()
+    info = await get_debug_info(update.effective_user.id)
+    info["workers"] = get_workers_stats()
+    info["journal"] = get_journal_stats()
     await update.message.reply_text(f"🐞 Debug info:\n{info}")
 
+# === Стан діалогів ===
+
+# До якого моменту (time.monotonic) не читати стан з бази після невдалої спроби
+state_retry_at = 0.0
+
+async def load_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Перед обробниками (група -1) читаємо з бази стан цього користувача в цьому чаті:
+    # попереднє повідомлення діалогу могло бути оброблене іншим процесом
+    global state_retry_at
+    user, chat = update.effective_user, update.effective_chat
+    if user is None or chat is None:
+        return
+    # Незаписані зміни попередніх оновлень цього процесу спершу потрапляють у буфер
+    # persistence, який при читанні має пріоритет над базою
+    await context.application.update_persistence()
+    names = [handler.name for handler in conversation_handlers]
+    if not journal_enabled():
+        user_data, states = await persistence.load_state(user.id, chat.id, names)
+    else:
+        # База недоступна — обробляємо зі станом, який уже є в пам'яті цього процесу
+        if time.monotonic() < state_retry_at:
+            return
+        try:
+            user_data, states = await persistence.load_state(user.id, chat.id, names, STATE_LOAD_TIMEOUT)
+        except Exception as e:
+            state_retry_at = time.monotonic() + STATE_RETRY_INTERVAL
+            logger.warning(f"⚠️ Стан діалогів недоступний, {STATE_RETRY_INTERVAL:g} с працюємо зі станом у пам'яті: {e}")
+            return
+    context.user_data.clear()
+    context.user_data.update(user_data)
+    for handler in conversation_handlers:
+        apply_conversation_state(handler, (chat.id, user.id), states[handler.name])
+
 # === Error Handler ===
 import traceback
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ERRORS.labels(type(context.error).__name__).inc()
     logger.error(f"Exception while handling update: {context.error}")
     traceback_str = ''.join(traceback.format_exception(None, context.error, context.error.__traceback__))
     logger.error(traceback_str)
 
 # === Telegram Application ===
 
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+persistence = DbPersistence()
+update_processor = PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES, UPDATE_QUEUE_SIZE)
+recent_updates = RecentUpdates(WEBHOOK_DEDUP_SIZE)
+
+builder = (
+    ApplicationBuilder()
+    .token(BOT_TOKEN)
+    .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    .concurrent_updates(update_processor)
+    .persistence(persistence)
+)
+if TELEGRAM_API_URL:
+    builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_API_URL.rstrip('/')}/file/bot")
+application = builder.build()
 
 # === ConversationHandler для ручного ввода ===
 manual_conv_handler = ConversationHandler(
+    name="manual",
+    persistent=True,
     entry_points=[CommandHandler("manual", manual_start)],
     states={
         WAITING_NAME: [
@@ -258,11 +754,16 @@ manual_conv_handler = ConversationHandler(
         CommandHandler("delete_check", delete_check),
         CommandHandler("delete_item", delete_item),
         CommandHandler("report_all", report_all),
+        CommandHandler("export", export),
+        CommandHandler("report_trend", report_trend),
+        CommandHandler("recategorize", recategorize),
     ],
     allow_reentry=True,
 )
 
 delete_check_conv_handler = ConversationHandler(
+    name="delete_check",
+    persistent=True,
     entry_points=[CommandHandler("delete_check", delete_check)],
     states={
         DELETE_CHECK_ID: [
@@ -282,11 +783,16 @@ delete_check_conv_handler = ConversationHandler(
         CommandHandler("delete_check", delete_check),
         CommandHandler("delete_item", delete_item),
         CommandHandler("report_all", report_all),
+        CommandHandler("export", export),
+        CommandHandler("report_trend", report_trend),
+        CommandHandler("recategorize", recategorize),
     ],
     allow_reentry=True,
 )
 
 delete_item_conv_handler = ConversationHandler(
+    name="delete_item",
+    persistent=True,
     entry_points=[CommandHandler("delete_item", delete_item)],
     states={
         DELETE_ITEM_ID: [
@@ -306,11 +812,16 @@ delete_item_conv_handler = ConversationHandler(
         CommandHandler("delete_check", delete_check),
         CommandHandler("delete_item", delete_item),
         CommandHandler("report_all", report_all),
+        CommandHandler("export", export),
+        CommandHandler("report_trend", report_trend),
+        CommandHandler("recategorize", recategorize),
     ],
     allow_reentry=True,
 )
 
 report_all_conv_handler = ConversationHandler(
+    name="report_all",
+    persistent=True,
     entry_points=[CommandHandler("report_all", report_all)],
     states={
         REPORT_ALL_FROM: [
@@ -334,15 +845,61 @@ report_all_conv_handler = ConversationHandler(
         CommandHandler("delete_check", delete_check),
         CommandHandler("delete_item", delete_item),
         CommandHandler("report_all", report_all),
+        CommandHandler("export", export),
+        CommandHandler("report_trend", report_trend),
+        CommandHandler("recategorize", recategorize),
+    ],
+    allow_reentry=True,
+)
+
+recategorize_conv_handler = ConversationHandler(
+    name="recategorize",
+    persistent=True,
+    entry_points=[CommandHandler("recategorize", recategorize)],
+    states={
+        RECATEGORIZE_ITEM: [
+            MessageHandler(filters.TEXT & (~filters.COMMAND), recategorize_item),
+            MessageHandler(filters.COMMAND, universal_command_exit),
+        ],
+        RECATEGORIZE_CATEGORY: [
+            MessageHandler(filters.TEXT & (~filters.COMMAND), recategorize_category),
+            MessageHandler(filters.COMMAND, universal_command_exit),
+        ],
+    },
+    fallbacks=[
+        CommandHandler("cancel", cancel),
+        CommandHandler("start", start),
+        CommandHandler("info", info),
+        CommandHandler("debug", debug),
+        CommandHandler("report_day", report_day),
+        CommandHandler("report_week", report_week),
+        CommandHandler("report_mounth", report_mounth),
+        CommandHandler("manual", manual_start),
+        CommandHandler("delete_check", delete_check),
+        CommandHandler("delete_item", delete_item),
+        CommandHandler("report_all", report_all),
+        CommandHandler("export", export),
+        CommandHandler("report_trend", report_trend),
+        CommandHandler("recategorize", recategorize),
     ],
     allow_reentry=True,
 )
 
+conversation_handlers = [
+    manual_conv_handler,
+    delete_check_conv_handler,
+    delete_item_conv_handler,
+    report_all_conv_handler,
+    recategorize_conv_handler,
+]
+application.add_handler(TypeHandler(Update, load_state), group=-1)
+
 # === ConversationHandler-ы ДО текстовых обработчиков! ===
 application.add_handler(manual_conv_handler)
 application.add_handler(delete_check_conv_handler)
 application.add_handler(delete_item_conv_handler)
 application.add_handler(report_all_conv_handler)
+application.add_handler(recategorize_conv_handler)
 
 # === Глобальные команды ===
 application.add_handler(CommandHandler("start", start))
@@ -356,13 +913,24 @@ application.add_handler(CommandHandler("delete_check", delete_check))
 application.add_handler(CommandHandler("delete_item", delete_item))
 application.add_handler(CommandHandler("report_all", report_all))
 application.add_handler(CommandHandler("cancel", cancel))
+application.add_handler(CommandHandler("export", export))
+application.add_handler(CommandHandler("report_trend", report_trend))
+application.add_handler(CommandHandler("recategorize", recategorize))
+application.add_handler(CallbackQueryHandler(check_page, pattern=r"^page:"))
 
 # === Только после этого универсальные обработчики ===
 application.add_handler(MessageHandler(filters.Document.FileExtension("xml"), handle_file))
+archive_filter = filters.Document.FileExtension(ARCHIVE_EXTENSIONS[0])
+for extension in ARCHIVE_EXTENSIONS[1:]:
+    archive_filter |= filters.Document.FileExtension(extension)
+application.add_handler(MessageHandler(archive_filter, handle_archive))
 application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
 
 application.add_error_handler(error_handler)
 
+UPDATE_QUEUE_DEPTH.set_function(lambda: update_processor.pending)
+JOURNAL_PENDING.set_function(get_pending)
+
 # === FastAPI Lifespan ===
 
 @asynccontextmanager
@@ -372,25 +940,95 @@ async def lifespan(app: FastAPI):
         logger.error("❌ WEBHOOK_URL не встановлено в середовищі!")
         yield
         return
-    init_db(DATABASE_URL)
+    await init_db(DATABASE_URL)
+    await init_http()
+    init_workers()
+    init_journal()
     await application.initialize()
     await application.start()
-    await application.bot.set_webhook(webhook_url)
+    if not WEBHOOK_SECRET:
+        logger.warning("⚠️ WEBHOOK_SECRET не встановлено — запити на вебхук не перевіряються")
+    await application.bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET)
     logger.info(f"✅ Вебхук встановлено на {webhook_url}")
+    start_recategorizer()
     yield
+    await stop_recategorizer()
     await application.stop()
+    await application.shutdown()
+    await close_journal()
+    await close_http()
+    close_workers()
+    await close_db()
 
 app = FastAPI(lifespan=lifespan)
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    db_ok = await check_db()
+    return {"status": "ok" if db_ok else "degraded", "db": db_ok}
+
+@app.get("/metrics")
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/export")
+async def export_route(
+    request: Request,
+    user_id: int,
+    fmt: str = Query("csv", alias="format"),
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+):
+    # Потокова відповідь: рядки йдуть клієнту пачками з серверного курсора
+    auth = request.headers.get("Authorization", "")
+    if not EXPORT_TOKEN:
+        return Response(status_code=404)
+    if not auth.startswith("Bearer ") or not check_secret_token(EXPORT_TOKEN, auth[len("Bearer "):]):
+        return Response(status_code=403)
+    if fmt not in EXPORT_FORMATS:
+        return Response(status_code=400)
+    try:
+        start = parse_date(from_date) if from_date else None
+        end = parse_date(to_date) if to_date else None
+    except ValueError:
+        return Response(status_code=400)
+    return StreamingResponse(
+        export_items(user_id, start, end, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="items-{user_id}.{fmt}"'},
+    )
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    update_data = await request.json()
-    update = Update.de_json(update_data, application.bot)
-    await application.update_queue.put(update)
+    # Секрет перевіряється до читання тіла, щоб чужі запити не коштували розбору JSON
+    if not check_secret_token(WEBHOOK_SECRET, request.headers.get(SECRET_HEADER)):
+        WEBHOOK_REQUESTS.labels("forbidden").inc()
+        return Response(status_code=403)
+    try:
+        update_data = orjson.loads(await request.body())
+        update_id = update_data["update_id"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        WEBHOOK_REQUESTS.labels("invalid").inc()
+        return Response(status_code=400)
+    # Повторна доставка вже прийнятого оновлення: підтверджуємо, але не обробляємо вдруге
+    if recent_updates.seen(update_id):
+        WEBHOOK_REQUESTS.labels("duplicate").inc()
+        return Response(status_code=200)
+    # Оновлення будується до admit(): зламане тіло не повинно займати місце в черзі
+    try:
+        update = Update.de_json(update_data, application.bot)
+    except Exception as e:
+        logger.warning(f"⚠️ Некоректне оновлення {update_id}: {e}")
+        WEBHOOK_REQUESTS.labels("invalid").inc()
+        return Response(status_code=400)
+    # Черга заповнена — Telegram повторить доставку пізніше, оновлення не втрачається
+    if not update_processor.admit():
+        WEBHOOK_REQUESTS.labels("busy").inc()
+        return Response(status_code=503, headers={"Retry-After": "1"})
+    application.update_queue.put_nowait(update)
+    recent_updates.add(update_id)
+    WEBHOOK_REQUESTS.labels("accepted").inc()
     return Response(status_code=200)
 
 def main():
@@ -0,0 +1,61 @@
+import os
+import asyncio
+import argparse
+import logging
+
+from utils.db import init_db, close_db, rebuild_rollup, claim_legacy_data
+from utils.recategorize import run_recategorize
+from utils.journal import JOURNAL_DIR, DEAD_LETTER_FILE, replay_dead_letters
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# === Команди обслуговування ===
+
+async def rebuild_rollup_command(args):
+    rows = await rebuild_rollup()
+    logger.info(f"✅ Денні підсумки перераховано: {rows} рядків")
+
+async def claim_legacy_command(args):
+    moved = await claim_legacy_data(args.user_id)
+    logger.info(f"✅ Користувачу {args.user_id} передано {moved} товарів без власника")
+
+async def recategorize_command(args):
+    # Без пауз між пачками: запускається вручну, коли бот не навантажений
+    changed = await run_recategorize(pause=0)
+    logger.info(f"✅ Перекатегоризовано {changed} товарів")
+
+async def replay_dead_letters_command(args):
+    if not JOURNAL_DIR:
+        logger.error("❌ JOURNAL_DIR не задано")
+        return
+    saved, failed = await replay_dead_letters()
+    logger.info(f"✅ З {DEAD_LETTER_FILE} збережено {saved} записів, залишилось {failed}")
+
+COMMANDS = {
+    "rebuild-rollup": (rebuild_rollup_command, "перерахувати таблицю денних підсумків з items"),
+    "claim-legacy": (claim_legacy_command, "передати дані без власника користувачу Telegram"),
+    "recategorize": (recategorize_command, "застосувати поточні правила категорій до збережених товарів"),
+    "replay-dead-letters": (replay_dead_letters_command, "повторно зберегти записи журналу, відкладені в dead-letter"),
+}
+
+async def run(args):
+    await init_db(DATABASE_URL)
+    try:
+        await COMMANDS[args.command][0](args)
+    finally:
+        await close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуговування бази даних бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        subparsers.add_parser(name, help=help_text)
+    subparsers.choices["claim-legacy"].add_argument("user_id", type=int, help="Telegram user id")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
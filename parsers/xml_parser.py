@@ -1,24 +1,43 @@
-import requests
+import hashlib
 from lxml import etree
 from io import BytesIO
 from datetime import datetime
-from utils.categories import categorize  # або заміни на: lambda name: "Інше"
+from dataclasses import dataclass
+from typing import Callable
+from utils.categories import categorize_many
 
-def parse_xml_file(file_path):
-    with open(file_path, "rb") as f:
-        return parse_xml_bytes(f.read())
+# === Реєстр форматів ===
+# Формат чека визначається тегом кореня документа. Для кожного формату є розбір готового
+# дерева (parse(root) -> позиції) і потоковий розбір (stream() -> об'єкт з feed/close).
+# Новий формат додається викликом register_format, без змін у коді вибору формату.
 
-def parse_xml_string(text):
-    return parse_xml_bytes(text.encode("utf-8"))
+@dataclass(frozen=True)
+class ReceiptFormat:
+    name: str
+    root_tag: str
+    parse: Callable
+    stream: Callable
+
+FORMATS = {}
+
+def register_format(name, root_tag, parse, stream):
+    if root_tag in FORMATS:
+        raise ValueError(f"Формат для кореня <{root_tag}> уже зареєстровано: {FORMATS[root_tag].name}")
+    FORMATS[root_tag] = ReceiptFormat(name, root_tag, parse, stream)
 
-def parse_xml_url(url):
+def find_format(root_tag):
+    return FORMATS.get(root_tag)
+
+def parse_xml_file(source):
+    # source — шлях до файлу або файловий об'єкт (наприклад, BytesIO із завантаженим документом)
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return parse_xml_bytes(response.content)
-    except:
+        return list(iter_xml_items(source))
+    except etree.XMLSyntaxError:
         return []
 
+def parse_xml_string(text):
+    return parse_xml_bytes(text.encode("utf-8"))
+
 def parse_xml_bytes(content):
     try:
         tree = etree.parse(BytesIO(content))
@@ -26,71 +45,310 @@ def parse_xml_bytes(content):
     except Exception:
         return []
 
-    if root.tag == "RQ":
-        return parse_format_atb(root)
-    elif root.tag == "CHECK":
-        return parse_format_tax(root)
-    else:
-        return []
+    receipt_format = find_format(root.tag)
+    return receipt_format.parse(root) if receipt_format else []
+
+def parse_xml_many(contents):
+    # Пачка документів за один виклик воркера (імпорт архівів)
+    return [parse_xml_bytes(content) for content in contents]
+
+# Елементи, які читає кожен формат: дерево обходиться один раз з фільтром за цими тегами
+ATB_TAGS = ("DAT", "P", "D", "TS")
+TAX_TAGS = ("ORDERDATE", "ORDERTIME", "ORDERNUM", "ORDERTAXNUM", "CASHREGISTERNUM", "ROW")
+# Ідентифікатори чека: атрибути <DAT> у АТБ і поля CHECKHEAD у податковому форматі
+ATB_HEAD_ATTRS = ("FN", "ZN", "DI")
+TAX_HEAD_TAGS = ("ORDERDATE", "ORDERTIME", "ORDERNUM", "ORDERTAXNUM", "CASHREGISTERNUM")
 
 def parse_format_atb(root):
-    date = extract_timestamp(root)
-    items_by_n = {}
-
-    # 1. Зчитуємо всі позиції <P>
-    for p in root.xpath(".//P"):
-        number = int(p.attrib.get("N", 0))
-        name = p.attrib.get("NM", "Невідомо")
-        summ = int(p.attrib.get("SM", "0"))
-
-        items_by_n[number] = {
-            "name": name,
-            "sum": summ,
-            "discount": 0,
-            "date": date,
-            "category": categorize(name)
-        }
-
-    # 2. Обробляємо знижки <D>
-    for d in root.xpath(".//D"):
-        ni = int(d.attrib.get("NI", 0))
-        discount = int(d.attrib.get("SM", "0"))
-        if ni in items_by_n:
-            items_by_n[ni]["sum"] -= discount
-            items_by_n[ni]["discount"] += discount
-            if items_by_n[ni]["sum"] < 0:
-                items_by_n[ni]["sum"] = 0
-
-    return list(items_by_n.values())
+    # Кожен <DAT> — окремий чек зі своїми позиціями, знижками, міткою часу і відбитком,
+    # як і в потоковому розборі. Дерево обходиться один раз.
+    items = []
+    receipt = None
+    for elem in root.iter(*ATB_TAGS):
+        if elem.tag == "DAT":
+            if receipt is not None:
+                items.extend(receipt.items())
+            receipt = AtbReceipt(atb_head(elem))
+        else:
+            if receipt is None:
+                receipt = AtbReceipt()
+            receipt.add(elem)
+    if receipt is not None:
+        items.extend(receipt.items())
+    return items
+
+class AtbReceipt:
+    # Один <DAT>: позиції <P>, знижки <D> і перша мітка <TS>. Спільний для розбору дерева
+    # і потокового розбору, тож обидва дають однакові позиції і відбитки.
+
+    def __init__(self, head=None):
+        # Атрибути <DAT>: фіскальний номер РРО, номер Z-звіту, номер документа
+        self.head = head or {}
+        self.positions = {}
+        # <D>, що прийшла раніше за свою <P>, застосовується при закритті чека
+        self.discounts = []
+        self.ts_raw = None
+
+    def add(self, elem):
+        tag = elem.tag
+        if tag == "P":
+            self.positions[int(elem.get("N", 0))] = {
+                "name": elem.get("NM", "Невідомо"),
+                "sum": int(elem.get("SM", "0")),
+                "discount": 0,
+            }
+        elif tag == "D":
+            ni = int(elem.get("NI", 0))
+            discount = int(elem.get("SM", "0"))
+            item = self.positions.get(ni)
+            if item is not None:
+                apply_discount(item, discount)
+            else:
+                self.discounts.append((ni, discount))
+        elif tag == "TS" and self.ts_raw is None:
+            self.ts_raw = elem.text
+
+    def items(self):
+        for ni, discount in self.discounts:
+            item = self.positions.get(ni)
+            if item is not None:
+                apply_discount(item, discount)
+        date = parse_timestamp(self.ts_raw) or datetime.now().strftime("%Y-%m-%d")
+        items = list(self.positions.values())
+        for item in items:
+            item["date"] = date
+        assign_categories(items)
+        assign_fingerprint(items, atb_fingerprint(self.head, self.ts_raw, items))
+        return items
 
 def parse_format_tax(root):
+    # Рядки CHECKBODY/ROW і поля CHECKHEAD за один прохід; дата розбирається один раз на чек
     items = []
-    for row in root.xpath(".//CHECKBODY/ROW"):
-        name = row.findtext("NAME", "Невідомо")
-        summ = float(row.findtext("COST", "0")) * 100
-        date_raw = root.findtext(".//ORDERDATE", "")
-        date = format_date(date_raw)
-        items.append({
-            "name": name,
-            "sum": int(summ),
-            "discount": 0,
-            "date": date,
-            "category": categorize(name)
-        })
+    head = {}
+    for elem in root.iter(*TAX_TAGS):
+        if elem.tag == "ROW":
+            parent = elem.getparent()
+            if parent is None or parent.tag != "CHECKBODY":
+                continue
+            items.append({
+                "name": elem.findtext("NAME", "Невідомо"),
+                "sum": int(float(elem.findtext("COST", "0")) * 100),
+                "discount": 0,
+            })
+        else:
+            head.setdefault(elem.tag, (elem.text or "").strip())
+    date = format_date(head.get("ORDERDATE", ""))
+    for item in items:
+        item["date"] = date
+    assign_categories(items)
+    assign_fingerprint(items, tax_fingerprint(head, items))
     return items
 
-def extract_timestamp(root):
-    ts = root.xpath(".//TS")
-    if ts:
-        raw = ts[0].text
-        try:
-            return datetime.strptime(raw, "%Y%m%d%H%M%S").strftime("%Y-%m-%d")
-        except:
-            pass
-    return datetime.now().strftime("%Y-%m-%d")
+def split_checks(items):
+    # Документ може містити кілька чеків (кілька <DAT>) зі своїми відбитками:
+    # кожен зберігається окремим чеком, щоб дублікати визначались по чеку, а не по файлу
+    checks = {}
+    for item in items:
+        checks.setdefault(item.get("fingerprint"), []).append(item)
+    return list(checks.values())
+
+def apply_discount(item, discount):
+    item["sum"] = max(item["sum"] - discount, 0)
+    item["discount"] += discount
+
+def assign_categories(items):
+    # Категоризуємо всі позиції чека одним викликом
+    for item, category in zip(items, categorize_many(item["name"] for item in items)):
+        item["category"] = category
+
+# === Відбиток чека ===
+# Однаковий чек, надісланий повторно, дає однаковий відбиток; за ним save_items_to_db
+# знаходить уже збережений чек замість створення дубліката.
+
+def receipt_fingerprint(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+# Вміст чека (дата з точністю до дня + позиції) — лише запасний варіант, коли чек не має
+# ідентифікаторів: дві однакові покупки за день за ним не розрізнити.
+
+def atb_fingerprint(head, ts_raw, items):
+    # Фіскальний номер РРО + час чека однозначно визначають чек
+    fiscal_number = head.get("FN")
+    ts = (ts_raw or "").strip()
+    if fiscal_number and ts:
+        return receipt_fingerprint("atb", fiscal_number, ts)
+    # Без часу чек визначає номер документа в межах РРО і Z-звіту
+    if ts or head.get("DI"):
+        return receipt_fingerprint("atb", *(head.get(attr) or "" for attr in ATB_HEAD_ATTRS), ts)
+    return receipt_fingerprint("atb", *((i["date"], i["name"], i["sum"], i["discount"]) for i in items))
+
+def atb_head(elem):
+    return {attr: elem.get(attr) for attr in ATB_HEAD_ATTRS if elem.get(attr)}
+
+def tax_fingerprint(head, items):
+    # Номер чека (ORDERNUM або фіскальний ORDERTAXNUM) разом з РРО, датою і часом визначає чек
+    ids = [head.get(tag, "") for tag in TAX_HEAD_TAGS]
+    if head.get("ORDERNUM") or head.get("ORDERTAXNUM"):
+        return receipt_fingerprint("tax", *ids)
+    return receipt_fingerprint("tax", *ids, *((i["name"], i["sum"]) for i in items))
+
+def assign_fingerprint(items, fingerprint):
+    for item in items:
+        item["fingerprint"] = fingerprint
+
+def parse_timestamp(raw):
+    try:
+        return datetime.strptime(raw, "%Y%m%d%H%M%S").strftime("%Y-%m-%d")
+    except:
+        return None
 
 def format_date(date_raw):
     try:
         return datetime.strptime(date_raw, "%d%m%Y").strftime("%Y-%m-%d")
     except:
         return datetime.now().strftime("%Y-%m-%d")
+
+# === Потоковий розбір ===
+# Документ читається подіями iterparse, позиції віддаються генератором, а оброблені
+# елементи видаляються з дерева, тож пам'ять не залежить від розміру файлу.
+
+def iter_xml_items(source):
+    # source — шлях або файловий об'єкт; XMLSyntaxError передається викликачу
+    stream = None
+    for event, elem in etree.iterparse(source, events=("start", "end")):
+        if stream is None:
+            stream = open_receipt_stream(elem.tag)
+            if stream is None:
+                return
+        yield from stream.feed(event, elem)
+    if stream is not None:
+        yield from stream.close()
+
+class ReceiptPullParser:
+    # Те саме для даних, що надходять частинами (наприклад, тіло HTTP-відповіді):
+    # feed() приймає байти і повертає готові позиції. unsupported стає True,
+    # якщо корінь документа не є відомим форматом чека.
+
+    def __init__(self):
+        self.parser = etree.XMLPullParser(events=("start", "end"))
+        self.stream = None
+        self.unsupported = False
+
+    def feed(self, data):
+        if self.unsupported:
+            return []
+        self.parser.feed(data)
+        return self._drain()
+
+    def close(self):
+        if self.unsupported:
+            return []
+        self.parser.close()
+        items = self._drain()
+        if self.stream is not None:
+            items.extend(self.stream.close())
+        return items
+
+    def _drain(self):
+        items = []
+        for event, elem in self.parser.read_events():
+            if self.stream is None:
+                self.stream = open_receipt_stream(elem.tag)
+                if self.stream is None:
+                    self.unsupported = True
+                    return items
+            items.extend(self.stream.feed(event, elem))
+        return items
+
+def open_receipt_stream(root_tag):
+    receipt_format = find_format(root_tag)
+    return receipt_format.stream() if receipt_format else None
+
+def release(elem):
+    # Звільняємо елемент і вже оброблених попередніх сусідів
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+class AtbStream:
+    # <P> накопичуються в межах <DAT>, поки не прийдуть їхні знижки <D> і мітка <TS>;
+    # на закритті <DAT> (або кореня) позиції віддаються і забуваються.
+
+    def __init__(self):
+        self.receipt = AtbReceipt()
+
+    def feed(self, event, elem):
+        if event == "start":
+            if elem.tag == "DAT":
+                self.receipt.head = atb_head(elem)
+            return []
+        tag = elem.tag
+        if tag in ("P", "D"):
+            self.receipt.add(elem)
+            release(elem)
+        elif tag == "TS":
+            self.receipt.add(elem)
+        elif tag in ("DAT", "RQ"):
+            items = self.flush()
+            release(elem)
+            return items
+        return []
+
+    def flush(self):
+        items = self.receipt.items()
+        self.receipt = AtbReceipt(self.receipt.head)
+        return items
+
+    def close(self):
+        return self.flush()
+
+class TaxStream:
+    # Відбиток чека залежить від усіх рядків, тож рядки (вже звільнені з дерева)
+    # накопичуються в межах одного <CHECK> і віддаються на його закритті.
+
+    def __init__(self):
+        self.pending = []
+        self.head = {}
+
+    def feed(self, event, elem):
+        if event != "end":
+            return []
+        tag = elem.tag
+        if tag == "ROW":
+            parent = elem.getparent()
+            if parent is None or parent.tag != "CHECKBODY":
+                return []
+            self.pending.append({
+                "name": elem.findtext("NAME", "Невідомо"),
+                "sum": int(float(elem.findtext("COST", "0")) * 100),
+                "discount": 0,
+            })
+            release(elem)
+        elif tag in TAX_HEAD_TAGS:
+            self.head.setdefault(tag, (elem.text or "").strip())
+        elif tag == "CHECK":
+            return self.flush()
+        return []
+
+    def flush(self):
+        date = format_date(self.head.get("ORDERDATE", ""))
+        items = self.pending
+        for item in items:
+            item["date"] = date
+        assign_categories(items)
+        assign_fingerprint(items, tax_fingerprint(self.head, items))
+        self.pending = []
+        self.head = {}
+        return items
+
+    def close(self):
+        return self.flush()
+
+register_format("atb", "RQ", parse_format_atb, AtbStream)
+register_format("tax", "CHECK", parse_format_tax, TaxStream)
@@ -0,0 +1,66 @@
+import os
+import tarfile
+import zipfile
+from io import BytesIO
+
+# Обмеження для архівів з чеками: кількість XML, розмір одного файлу і всіх разом після розпакування
+ARCHIVE_MAX_FILES = int(os.getenv("ARCHIVE_MAX_FILES", "2000"))
+ARCHIVE_MAX_FILE_SIZE = int(os.getenv("ARCHIVE_MAX_FILE_SIZE", str(5 * 1024 * 1024)))
+ARCHIVE_MAX_TOTAL_SIZE = int(os.getenv("ARCHIVE_MAX_TOTAL_SIZE", str(100 * 1024 * 1024)))
+
+ARCHIVE_EXTENSIONS = ("zip", "tar", "tar.gz", "tgz", "tar.bz2", "tar.xz")
+
+class ArchiveError(Exception):
+    pass
+
+def read_archive(source):
+    # source — байти, файловий об'єкт або шлях. Повертає [(ім'я, вміст), ...] для всіх
+    # XML-файлів архіву; ArchiveError — якщо архів пошкоджений або перевищує обмеження.
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    reader = ArchiveReader()
+    try:
+        if zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and reader.wants(info.filename, info.file_size):
+                        with archive.open(info) as member:
+                            reader.add(info.filename, member)
+        else:
+            if hasattr(source, "seek"):
+                source.seek(0)
+                archive = tarfile.open(fileobj=source, mode="r:*")
+            else:
+                archive = tarfile.open(source, mode="r:*")
+            with archive:
+                for info in archive:
+                    if info.isfile() and reader.wants(info.name, info.size):
+                        reader.add(info.name, archive.extractfile(info))
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        raise ArchiveError("Не вдалося прочитати архів (підтримуються ZIP і tar)") from e
+    return reader.files
+
+class ArchiveReader:
+    def __init__(self):
+        self.files = []
+        self.total = 0
+
+    def wants(self, name, size):
+        base = os.path.basename(name)
+        if not base.lower().endswith(".xml") or base.startswith(".") or name.startswith("__MACOSX/"):
+            return False
+        if len(self.files) >= ARCHIVE_MAX_FILES:
+            raise ArchiveError(f"В архіві більше {ARCHIVE_MAX_FILES} XML-файлів")
+        if size > ARCHIVE_MAX_FILE_SIZE:
+            raise ArchiveError(f"Файл {name} більший за {ARCHIVE_MAX_FILE_SIZE // 1024} КБ")
+        return True
+
+    def add(self, name, member):
+        # Заявленому розміру не довіряємо: читаємо не більше межі + 1 байт
+        content = member.read(ARCHIVE_MAX_FILE_SIZE + 1)
+        if len(content) > ARCHIVE_MAX_FILE_SIZE:
+            raise ArchiveError(f"Файл {name} більший за {ARCHIVE_MAX_FILE_SIZE // 1024} КБ")
+        self.total += len(content)
+        if self.total > ARCHIVE_MAX_TOTAL_SIZE:
+            raise ArchiveError(f"Розпакований архів більший за {ARCHIVE_MAX_TOTAL_SIZE // (1024 * 1024)} МБ")
+        self.files.append((name, content))
@@ -1,4 +1,12 @@
+import os
 import re
+import json
+import time
+import logging
+from collections import deque
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
 
 # Таблиця заміни подібних латинських літер на кириличні
 SIMILAR_LETTERS = {
@@ -15,40 +23,169 @@ SIMILAR_LETTERS = {
     'i': 'і', 'I': 'І',
     'r': 'р',
 }
+SIMILAR_LETTERS_TABLE = str.maketrans(SIMILAR_LETTERS)
+
+NON_WORD_RE = re.compile(r'[^а-яіїєґa-z0-9 ]')
+SPACES_RE = re.compile(r'\s+')
+
+DEFAULT_CATEGORY = "Інше"
+CATEGORY_CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", "8192"))
+
+# Правила лежать у JSON-файлі з номером версії: {"version": N, "rules": {категорія: [слова]}}.
+# Порядок важливий: перемагає перша категорія, ключове слово якої знайдено в назві.
+CATEGORY_RULES_PATH = os.getenv(
+    "CATEGORY_RULES_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "categories.json"),
+)
+# Як часто (секунди) перевіряти, чи змінився файл правил
+CATEGORY_RULES_POLL = float(os.getenv("CATEGORY_RULES_POLL", "5"))
+
+def load_rules(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    rules = data["rules"]
+    if not isinstance(rules, dict):
+        raise ValueError("rules має бути об'єктом {категорія: [ключові слова]}")
+    return int(data["version"]), rules
 
 def normalize_text(text):
     # Заміна подібних літер
-    normalized = ''.join(SIMILAR_LETTERS.get(ch, ch) for ch in text)
+    normalized = text.translate(SIMILAR_LETTERS_TABLE)
     normalized = normalized.lower()
     # Залишаємо тільки літери, цифри і пробіли
-    normalized = re.sub(r'[^а-яіїєґa-z0-9 ]', ' ', normalized)
-    normalized = re.sub(r'\s+', ' ', normalized).strip()
+    normalized = NON_WORD_RE.sub(' ', normalized)
+    normalized = SPACES_RE.sub(' ', normalized).strip()
     return normalized
 
+class KeywordMatcher:
+    # Автомат Ахо-Корасік над нормалізованими ключовими словами.
+    # Для кожного стану зберігається найвищий пріоритет (найменший індекс категорії),
+    # досяжний через суфіксні посилання, тож один прохід по назві дає ту саму
+    # категорію, що й послідовний перебір категорій і слів.
+
+    def __init__(self, rules):
+        self.categories = []
+        self._goto = [{}]
+        self._best = [None]
+        for priority, (cat, keywords) in enumerate(rules.items()):
+            self.categories.append(cat.capitalize())
+            for word in keywords:
+                word = normalize_text(word)
+                if word:
+                    self._add(word, priority)
+        self._build_links()
+
+    def _add(self, word, priority):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._best.append(None)
+            node = nxt
+        if self._best[node] is None or priority < self._best[node]:
+            self._best[node] = priority
+
+    def _build_links(self):
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            fail_best = self._best[self._fail[node]]
+            if fail_best is not None and (self._best[node] is None or fail_best < self._best[node]):
+                self._best[node] = fail_best
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[child] = self._goto[f].get(ch, 0)
+
+    def match(self, normalized):
+        goto, fail, best_of = self._goto, self._fail, self._best
+        node = 0
+        best = None
+        for ch in normalized:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            found = best_of[node]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        if best is None:
+            return DEFAULT_CATEGORY
+        return self.categories[best]
+
+# Версія і скомпільований автомат замінюються разом одним присвоєнням, тож потоки,
+# що саме категоризують, бачать або старі, або нові правила, але не їхню суміш
+RULES_VERSION, CATEGORY_RULES = load_rules(CATEGORY_RULES_PATH)
+_RULES = (RULES_VERSION, KeywordMatcher(CATEGORY_RULES))
+_rules_mtime = os.stat(CATEGORY_RULES_PATH).st_mtime_ns
+_rules_checked = time.monotonic()
+
+def get_rules_version():
+    return _RULES[0]
+
+def get_category_names():
+    # Назви категорій у тому вигляді, в якому їх повертає categorize
+    return list(_RULES[1].categories)
+
+def reload_rules():
+    # Перечитує файл, якщо він змінився; нові правила застосовуються лише з новою версією.
+    # Повертає True, якщо правила замінено. Помилки формату передаються викликачу,
+    # старі правила при цьому лишаються чинними.
+    global _RULES, RULES_VERSION, CATEGORY_RULES, _rules_mtime
+    mtime = os.stat(CATEGORY_RULES_PATH).st_mtime_ns
+    if mtime == _rules_mtime:
+        return False
+    version, rules = load_rules(CATEGORY_RULES_PATH)
+    _rules_mtime = mtime
+    if version == _RULES[0]:
+        return False
+    _RULES = (version, KeywordMatcher(rules))
+    RULES_VERSION, CATEGORY_RULES = version, rules
+    _match_cached.cache_clear()
+    logger.info(f"✅ Правила категорій оновлено до версії {version}")
+    return True
+
+def maybe_reload_rules():
+    # Не частіше ніж раз на CATEGORY_RULES_POLL; так правила підхоплюють і процеси-воркери
+    global _rules_checked
+    now = time.monotonic()
+    if now - _rules_checked < CATEGORY_RULES_POLL:
+        return
+    _rules_checked = now
+    try:
+        reload_rules()
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"❌ Не вдалося завантажити правила категорій: {e}")
+
+# Кеш прив'язаний до автомата: результат старих правил не може потрапити під нові
+@lru_cache(maxsize=CATEGORY_CACHE_SIZE)
+def _match_cached(normalized, matcher):
+    return matcher.match(normalized)
+
+def clear_category_cache():
+    _match_cached.cache_clear()
+
+def categorize_normalized(normalized: str) -> str:
+    return _match_cached(normalized, _RULES[1])
+
 def categorize(name: str) -> str:
-    name = normalize_text(name)
-
-    categories = {
-        "алкоголь": ["пиво", "вино", "горілка", "коньяк", "лікер", "ром"],
-        "яйця": ["яйце", "яйця"],
-        "консерви": ["кукурудза", "консеpвована", "Паштет"],
-        "овочі": ["огурец", "огурцы", "огірки", "картопля", "морква", "огірок", "капуста", "цибуля", "буряк", "перець", "томат", "помідор", "часник", "Кабачки" , "помидор"],
-        "фрукти": ["яблуко", "банан", "виноград", "апельсин", "мандарин", "груша", "лимон", "слива", "кавун", "персик"],
-        "молочка": ["сир", "сыр", "молоко", "йогурт", "кефір", "сметана", "творог", "вершки", "ряжанка", "масло"],
-        "сигарети": ["сигарет", "цигарк", "tobacco", "marlboro", "kent", "camel", "bond", "parliament"],
-        "м'ясо та ковбаси": ["мясо", "риба", "рыба", "виpіб фаpшевий", "ковбас", "сосиск", "бекон", "шинка", "м'ясо", "салямі", "грудинка", "курка", "свинина", "яловичина"],
-        "випічка": ["хлеб", "хліб", "булка", "паляниця", "круасан", "бублик", "лаваш", "батон"],
-        "каша і крупи": ["Булгур", "гречка", "рис", "пшоно", "ячмінь", "вівсянка", "манка", "перловка", "крупа"],
-        "напої": ["сік", "вода", "компот", "квас", "чай", "кава", "лимонад", "газована", "негазована"],
-        "снеки та солодощі": ["печиво", "шоколад", "цукер", "батончик", "снек", "вафл", "морозиво", "арахіс", "насіння", "попкорн", "крекер"],
-        "соуси і спеції": ["соус", "кетчуп", "майонез", "сіль", "перець", "куркума", "приправа", "гірчиця", "оцет", "Кислота оцтова"],
-        "побутове": ["паста зубна", "плiвка харчова", "палички ватнi", "пакет", "серветк", "губка", "мішок", "мило", "шампунь", "туалет", "засіб", "порошок", "щітка", "рукавички", "Стрiчка липка"],
-        "інше": []
-    }
-
-    for cat, keywords in categories.items():
-        for word in keywords:
-            if word in name:
-                return cat.capitalize()
-
-    return "Інше"
+    return categorize_normalized(normalize_text(name))
+
+def categorize_many(names) -> list:
+    # Одна нормалізація і один пошук на кожну унікальну назву в чеку
+    maybe_reload_rules()
+    resolved = {}
+    result = []
+    for name in names:
+        category = resolved.get(name)
+        if category is None:
+            category = resolved[name] = categorize(name)
+        result.append(category)
+    return result
@@ -1,106 +1,858 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime, timedelta
+import os
+from collections import OrderedDict
+from datetime import date, timedelta
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 
-DB_URL = None
+from utils import report_cache, override_cache
+from utils.categories import normalize_text
+from utils.metrics import timed_db_call
 
-def init_db(url: str):
-    global DB_URL
-    DB_URL = url
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Неактивні з'єднання понад мінімум закриваються, усі перевідкриваються раз на max_lifetime
+POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
 
-def get_connection():
-    if not DB_URL:
+# Скільки останніх відбитків чеків тримати в пам'яті для швидкої перевірки дублікатів
+FINGERPRINT_CACHE_SIZE = int(os.getenv("FINGERPRINT_CACHE_SIZE", "10000"))
+# Перевірка планів гарячих запитів під час старту: повне сканування таблиці — помилка
+DB_PLAN_CHECK = os.getenv("DB_PLAN_CHECK", "1") == "1"
+PLAN_CHECK_TABLES = {"checks", "items", "daily_category_totals", "bot_state", "category_overrides"}
+# Межа items."sum" (INTEGER, копійки)
+ITEM_SUM_MAX = 2**31 - 1
+
+# Дані належать користувачу Telegram (user_id); рядки, створені до появи власника,
+# мають user_id = 0 і можуть бути передані користувачу командою manage.py claim-legacy
+SCHEMA_SQL = (
+    "CREATE TABLE IF NOT EXISTS checks ("
+    "id SERIAL PRIMARY KEY, "
+    "user_id BIGINT NOT NULL DEFAULT 0, "
+    "fingerprint TEXT, "
+    "created_at TIMESTAMPTZ NOT NULL DEFAULT now());",
+    "CREATE TABLE IF NOT EXISTS items ("
+    "id SERIAL PRIMARY KEY, "
+    "check_id INTEGER NOT NULL REFERENCES checks (id) ON DELETE CASCADE, "
+    "user_id BIGINT NOT NULL DEFAULT 0, "
+    "date DATE NOT NULL, "
+    "name TEXT NOT NULL, "
+    "category TEXT NOT NULL, "
+    '"sum" INTEGER NOT NULL);',
+    # Старі бази, створені поза проєктом: доводимо до тієї ж схеми
+    "ALTER TABLE checks ADD COLUMN IF NOT EXISTS fingerprint TEXT;",
+    "ALTER TABLE checks ADD COLUMN IF NOT EXISTS user_id BIGINT NOT NULL DEFAULT 0;",
+    "ALTER TABLE items ADD COLUMN IF NOT EXISTS user_id BIGINT NOT NULL DEFAULT 0;",
+    "DROP INDEX IF EXISTS checks_fingerprint_key;",
+    "CREATE UNIQUE INDEX IF NOT EXISTS checks_user_fingerprint_key ON checks (user_id, fingerprint);",
+    "CREATE INDEX IF NOT EXISTS items_user_date_idx ON items (user_id, date);",
+    # Також дає позиції чека в порядку id для посторінкового виводу
+    "DROP INDEX IF EXISTS items_user_check_idx;",
+    "CREATE INDEX IF NOT EXISTS items_user_check_id_idx ON items (user_id, check_id, id);",
+    # Потрібен для перевірки зовнішнього ключа при видаленні чека
+    "CREATE INDEX IF NOT EXISTS items_check_idx ON items (check_id);",
+    # NOT VALID: ключ діє для нових рядків і не вимагає перевірки всієї таблиці
+    "DO $$ BEGIN "
+    "IF NOT EXISTS (SELECT 1 FROM pg_constraint "
+    "WHERE conrelid = 'items'::regclass AND confrelid = 'checks'::regclass AND contype = 'f') THEN "
+    "ALTER TABLE items ADD CONSTRAINT items_check_id_fkey FOREIGN KEY (check_id) "
+    "REFERENCES checks (id) ON DELETE CASCADE NOT VALID; "
+    "END IF; END $$;",
+    # Таблиця підсумків без user_id — похідні дані, її простіше перебудувати
+    "DO $$ BEGIN "
+    "IF EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'daily_category_totals') "
+    "AND NOT EXISTS (SELECT 1 FROM information_schema.columns "
+    "WHERE table_name = 'daily_category_totals' AND column_name = 'user_id') THEN "
+    "DROP TABLE daily_category_totals; "
+    "END IF; END $$;",
+    # Денні підсумки по категоріях; оновлюються в тих самих транзакціях, що й items
+    "CREATE TABLE IF NOT EXISTS daily_category_totals ("
+    "user_id BIGINT NOT NULL, "
+    "date DATE NOT NULL, "
+    "category TEXT NOT NULL, "
+    "total BIGINT NOT NULL DEFAULT 0, "
+    "items_count INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (user_id, date, category));",
+    # Стан діалогів і context.user_data, спільний для всіх процесів бота.
+    # user_data зберігається з chat_id = 0, стани ConversationHandler — під його name.
+    "CREATE TABLE IF NOT EXISTS bot_state ("
+    "user_id BIGINT NOT NULL, "
+    "chat_id BIGINT NOT NULL, "
+    "name TEXT NOT NULL, "
+    "data JSONB NOT NULL, "
+    "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (user_id, chat_id, name));",
+    # Прогрес фонових робіт (перекатегоризація): з якої версії правил і до якого id дійшли
+    "CREATE TABLE IF NOT EXISTS job_checkpoints ("
+    "name TEXT PRIMARY KEY, "
+    "version INTEGER NOT NULL, "
+    "last_id BIGINT NOT NULL DEFAULT 0, "
+    "finished BOOLEAN NOT NULL DEFAULT false, "
+    "updated_at TIMESTAMPTZ NOT NULL DEFAULT now());",
+    # Виправлення категорій від користувача; name — нормалізована назва товару (normalize_text)
+    "CREATE TABLE IF NOT EXISTS category_overrides ("
+    "user_id BIGINT NOT NULL, "
+    "name TEXT NOT NULL, "
+    "category TEXT NOT NULL, "
+    "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (user_id, name));",
+)
+
+# === Гарячі запити ===
+# Виконуються з prepare=True: кожне з'єднання пулу готує їх на сервері один раз.
+
+RESERVE_IDS_SQL = (
+    "SELECT "
+    "ARRAY(SELECT nextval(pg_get_serial_sequence('checks', 'id')) "
+    "FROM generate_series(1, %s)) AS check_ids, "
+    "ARRAY(SELECT nextval(pg_get_serial_sequence('items', 'id')) "
+    "FROM generate_series(1, %s)) AS item_ids;"
+)
+
+INSERT_CHECKS_SQL = (
+    "INSERT INTO checks (id, user_id, fingerprint) "
+    "SELECT id, %s, fingerprint FROM unnest(%s::bigint[], %s::text[]) AS t(id, fingerprint) "
+    "ON CONFLICT (user_id, fingerprint) DO NOTHING RETURNING id;"
+)
+
+INSERT_ITEMS_SQL = (
+    'INSERT INTO items (id, user_id, check_id, date, name, category, "sum") '
+    "SELECT id, %s, check_id, date, name, category, s FROM unnest(%s::bigint[], %s::bigint[], "
+    "%s::date[], %s::text[], %s::text[], %s::bigint[]) AS t(id, check_id, date, name, category, s);"
+)
+
+FIND_FINGERPRINTS_SQL = (
+    "SELECT id, fingerprint FROM checks WHERE user_id = %s AND fingerprint = ANY(%s::text[]);"
+)
+
+# Рядок є для кожного наявного чека, навіть якщо всі його товари видалено
+ITEM_IDS_SQL = (
+    "SELECT c.id AS check_id, "
+    "COALESCE(array_agg(i.id ORDER BY i.id) FILTER (WHERE i.id IS NOT NULL), '{}') AS ids "
+    "FROM checks c LEFT JOIN items i ON i.user_id = c.user_id AND i.check_id = c.id "
+    "WHERE c.user_id = %s AND c.id = ANY(%s::bigint[]) GROUP BY c.id;"
+)
+
+# Відсутня межа періоду — NULL, тож усі види звітів обслуговує один підготовлений запит
+REPORT_SQL = (
+    "SELECT category, SUM(total)::bigint AS total FROM daily_category_totals "
+    "WHERE user_id = %s "
+    "AND date >= COALESCE(%s::date, '-infinity'::date) "
+    "AND date <= COALESCE(%s::date, 'infinity'::date) "
+    "GROUP BY category;"
+)
+
+# Сторінки позицій чека: keyset за id у обидва боки, LIMIT на один рядок більший за
+# сторінку, щоб дізнатися, чи є продовження
+CHECK_PAGE_AFTER_SQL = (
+    'SELECT id, name, category, "sum" FROM items '
+    "WHERE user_id = %s AND check_id = %s AND id > %s ORDER BY id LIMIT %s;"
+)
+
+CHECK_PAGE_BEFORE_SQL = (
+    'SELECT id, name, category, "sum" FROM items '
+    "WHERE user_id = %s AND check_id = %s AND id < %s ORDER BY id DESC LIMIT %s;"
+)
+
+CHECK_TOTAL_SQL = (
+    'SELECT COUNT(*) AS count, COALESCE(SUM("sum"), 0)::bigint AS total FROM items '
+    "WHERE user_id = %s AND check_id = %s;"
+)
+
+# Товари за період для експорту; читається серверним курсором пачками
+EXPORT_ITEMS_SQL = (
+    'SELECT date, name, category, "sum", check_id FROM items '
+    "WHERE user_id = %s "
+    "AND date >= COALESCE(%s::date, '-infinity'::date) "
+    "AND date <= COALESCE(%s::date, 'infinity'::date) "
+    "ORDER BY date, id;"
+)
+
+# Тренд за один прохід по денних підсумках: суми по відрізках (день/тиждень) і категоріях,
+# порожні відрізки доповнюються нулями, зміна до попереднього відрізка — через LAG
+TREND_SQL = (
+    "WITH totals AS ("
+    "SELECT date_trunc(%(unit)s, date)::date AS bucket, category, SUM(total)::bigint AS total "
+    "FROM daily_category_totals "
+    "WHERE user_id = %(user_id)s AND date >= %(start)s AND date <= %(end)s "
+    "GROUP BY 1, 2"
+    "), buckets AS ("
+    "SELECT generate_series(%(start)s::date, %(end)s::date, %(step)s::interval)::date AS bucket"
+    "), categories AS ("
+    "SELECT DISTINCT category FROM totals"
+    ") "
+    "SELECT b.bucket, c.category, COALESCE(t.total, 0) AS total, "
+    "COALESCE(t.total, 0) - LAG(COALESCE(t.total, 0)) "
+    "OVER (PARTITION BY c.category ORDER BY b.bucket) AS delta "
+    "FROM buckets b CROSS JOIN categories c "
+    "LEFT JOIN totals t ON t.bucket = b.bucket AND t.category = c.category "
+    "ORDER BY b.bucket, c.category;"
+)
+
+# === Перекатегоризація ===
+
+ITEMS_AFTER_SQL = (
+    "SELECT id, user_id, name, category FROM items WHERE id > %s ORDER BY id LIMIT %s;"
+)
+
+# Усі назви чека (або пачки чеків) одним запитом
+OVERRIDES_SQL = (
+    "SELECT name, category FROM category_overrides WHERE user_id = %s AND name = ANY(%s::text[]);"
+)
+
+# Змінює категорію лише там, де вона справді інша; o — знімок рядка до зміни
+RECATEGORIZE_SQL = (
+    "UPDATE items i SET category = c.category "
+    "FROM items o JOIN unnest(%s::bigint[], %s::text[]) AS c(id, category) ON c.id = o.id "
+    "WHERE i.id = o.id AND o.category <> c.category "
+    'RETURNING i.user_id, i.date, i."sum", o.category AS old_category, c.category AS new_category;'
+)
+
+ROLLUP_SUBTRACT_MANY_SQL = (
+    "UPDATE daily_category_totals t SET "
+    "total = t.total - d.total, items_count = t.items_count - d.items_count "
+    "FROM (SELECT user_id, date, category, SUM(s) AS total, COUNT(*) AS items_count "
+    "FROM unnest(%s::bigint[], %s::date[], %s::text[], %s::bigint[]) AS x(user_id, date, category, s) "
+    "GROUP BY user_id, date, category) d "
+    "WHERE t.user_id = d.user_id AND t.date = d.date AND t.category = d.category;"
+)
+
+ROLLUP_ADD_MANY_SQL = (
+    "INSERT INTO daily_category_totals (user_id, date, category, total, items_count) "
+    "SELECT user_id, date, category, SUM(s), COUNT(*) "
+    "FROM unnest(%s::bigint[], %s::date[], %s::text[], %s::bigint[]) AS x(user_id, date, category, s) "
+    "GROUP BY user_id, date, category "
+    "ON CONFLICT (user_id, date, category) DO UPDATE SET "
+    "total = daily_category_totals.total + EXCLUDED.total, "
+    "items_count = daily_category_totals.items_count + EXCLUDED.items_count;"
+)
+
+ROLLUP_CLEANUP_MANY_SQL = (
+    "DELETE FROM daily_category_totals t "
+    "USING unnest(%s::bigint[], %s::date[]) AS d(user_id, date) "
+    "WHERE t.user_id = d.user_id AND t.date = d.date AND t.items_count <= 0;"
+)
+
+ROLLUP_ADD_SQL = (
+    "INSERT INTO daily_category_totals (user_id, date, category, total, items_count) "
+    "SELECT %s, date, category, SUM(s), COUNT(*) "
+    "FROM unnest(%s::date[], %s::text[], %s::bigint[]) AS t(date, category, s) "
+    "GROUP BY date, category "
+    "ON CONFLICT (user_id, date, category) DO UPDATE SET "
+    "total = daily_category_totals.total + EXCLUDED.total, "
+    "items_count = daily_category_totals.items_count + EXCLUDED.items_count;"
+)
+
+# Видаляє товари за умовою {where} і віднімає їх із денних підсумків одним запитом
+ROLLUP_DELETE_ITEMS_SQL = (
+    "WITH deleted AS ("
+    'DELETE FROM items WHERE user_id = %s AND {where} RETURNING user_id, date, category, "sum"'
+    "), changed AS ("
+    "UPDATE daily_category_totals t SET "
+    "total = t.total - d.total, items_count = t.items_count - d.items_count "
+    'FROM (SELECT user_id, date, category, SUM("sum") AS total, COUNT(*) AS items_count '
+    "FROM deleted GROUP BY user_id, date, category) d "
+    "WHERE t.user_id = d.user_id AND t.date = d.date AND t.category = d.category"
+    ") "
+    "SELECT COUNT(*) AS count, array_agg(DISTINCT date) AS dates FROM deleted;"
+)
+
+LOAD_STATE_SQL = (
+    "SELECT chat_id, name, data FROM bot_state WHERE user_id = %s AND chat_id IN (0, %s);"
+)
+
+SAVE_STATE_SQL = (
+    "INSERT INTO bot_state (user_id, chat_id, name, data) "
+    "SELECT user_id, chat_id, name, data::jsonb "
+    "FROM unnest(%s::bigint[], %s::bigint[], %s::text[], %s::text[]) AS t(user_id, chat_id, name, data) "
+    "ON CONFLICT (user_id, chat_id, name) DO UPDATE SET data = EXCLUDED.data, updated_at = now();"
+)
+
+DELETE_STATE_SQL = (
+    "DELETE FROM bot_state s "
+    "USING unnest(%s::bigint[], %s::bigint[], %s::text[]) AS t(user_id, chat_id, name) "
+    "WHERE s.user_id = t.user_id AND s.chat_id = t.chat_id AND s.name = t.name;"
+)
+
+POOL = None
+# (user_id, fingerprint) -> check_id для вже збережених чеків
+_KNOWN_FINGERPRINTS = OrderedDict()
+
+async def init_db(url: str):
+    global POOL
+    if not url:
+        raise RuntimeError("DATABASE_URL не встановлено!")
+    # Схема створюється до відкриття пулу: з'єднання пулу одразу готують запити до неї
+    async with await AsyncConnection.connect(url, autocommit=True) as conn:
+        for statement in SCHEMA_SQL:
+            await conn.execute(statement)
+    POOL = AsyncConnectionPool(
+        url,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        timeout=POOL_TIMEOUT,
+        max_idle=POOL_MAX_IDLE,
+        max_lifetime=POOL_MAX_LIFETIME,
+        kwargs={"row_factory": dict_row},
+        configure=prepare_connection,
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+    # Прогріваємо пул: чекаємо, поки відкриються min_size з'єднань
+    await POOL.open(wait=True)
+    async with POOL.connection() as conn:
+        if DB_PLAN_CHECK:
+            await verify_query_plans(conn)
+        # Перший запуск після появи таблиці підсумків: заповнюємо її з наявних товарів
+        cur = await conn.execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM daily_category_totals) "
+            "AND EXISTS (SELECT 1 FROM items) AS needs_rebuild;"
+        )
+        needs_rebuild = (await cur.fetchone())["needs_rebuild"]
+    if needs_rebuild:
+        await rebuild_rollup()
+
+async def prepare_connection(conn):
+    # Запити на читання готуються при відкритті з'єднання, на запис — при першому виконанні
+    await conn.execute(REPORT_SQL, (0, None, None), prepare=True)
+    await conn.execute(FIND_FINGERPRINTS_SQL, (0, []), prepare=True)
+    await conn.execute(ITEM_IDS_SQL, (0, []), prepare=True)
+    await conn.execute(LOAD_STATE_SQL, (0, 0), prepare=True)
+    await conn.execute(OVERRIDES_SQL, (0, []), prepare=True)
+    await conn.commit()
+
+def find_seq_scans(plan):
+    scans = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in PLAN_CHECK_TABLES:
+        scans.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans.extend(find_seq_scans(child))
+    return scans
+
+async def verify_query_plans(conn):
+    # Із enable_seqscan = off планувальник обере Seq Scan лише тоді, коли придатного
+    # індексу немає, тож розмір таблиць (і порожня база) на результат не впливає
+    today = date.today()
+    cases = [
+        ("report day", REPORT_SQL, (0, today, today)),
+        ("report week", REPORT_SQL, (0, today - timedelta(days=7), None)),
+        ("report all", REPORT_SQL, (0, None, None)),
+        ("find fingerprints", FIND_FINGERPRINTS_SQL, (0, ["-"])),
+        ("item ids", ITEM_IDS_SQL, (0, [0])),
+        ("delete check items", ROLLUP_DELETE_ITEMS_SQL.format(where="check_id = %s"), (0, 0)),
+        ("delete item", ROLLUP_DELETE_ITEMS_SQL.format(where="id = %s"), (0, 0)),
+        ("load state", LOAD_STATE_SQL, (0, 0)),
+        ("export items", EXPORT_ITEMS_SQL, (0, None, None)),
+        ("check page after", CHECK_PAGE_AFTER_SQL, (0, 0, 0, 1)),
+        ("items after", ITEMS_AFTER_SQL, (0, 1)),
+        ("category overrides", OVERRIDES_SQL, (0, ["-"])),
+        ("trend", TREND_SQL, {"unit": "week", "user_id": 0, "start": today, "end": today, "step": "1 week"}),
+        ("check page before", CHECK_PAGE_BEFORE_SQL, (0, 0, 0, 1)),
+        ("check total", CHECK_TOTAL_SQL, (0, 0)),
+    ]
+    failures = []
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off;")
+        for name, sql, params in cases:
+            cur = await conn.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = (await cur.fetchone())["QUERY PLAN"][0]["Plan"]
+            for table in find_seq_scans(plan):
+                failures.append(f"{name}: {table}")
+    if failures:
+        raise RuntimeError("Гарячі запити виконують повне сканування таблиць: " + ", ".join(failures))
+
+async def close_db():
+    global POOL
+    if POOL is not None:
+        await POOL.close()
+        POOL = None
+
+def get_pool():
+    if POOL is None:
         raise RuntimeError("DATABASE_URL не ініціалізовано! Викличте init_db(DATABASE_URL).")
-    return psycopg2.connect(DB_URL, cursor_factory=RealDictCursor)
+    return POOL
 
-def save_items_to_db(items):
-    conn = get_connection()
+async def check_db():
     try:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO checks DEFAULT VALUES RETURNING id;")
-        check_id = cur.fetchone()['id']
-        item_ids = []
+        async with get_pool().connection() as conn:
+            await conn.execute("SELECT 1;")
+        return True
+    except Exception:
+        return False
+
+def get_pool_stats():
+    stats = get_pool().get_stats()
+    return {
+        "size": stats.get("pool_size", 0),
+        "available": stats.get("pool_available", 0),
+        "waiting": stats.get("requests_waiting", 0),
+    }
+
+def remember_fingerprint(user_id, fingerprint, check_id):
+    key = (user_id, fingerprint)
+    _KNOWN_FINGERPRINTS[key] = check_id
+    _KNOWN_FINGERPRINTS.move_to_end(key)
+    if len(_KNOWN_FINGERPRINTS) > FINGERPRINT_CACHE_SIZE:
+        _KNOWN_FINGERPRINTS.popitem(last=False)
+
+def get_fingerprint(items):
+    return items[0].get("fingerprint") if items else None
+
+async def save_items_to_db(user_id, items):
+    return (await save_checks_to_db(user_id, [items]))[0]
+
+# Зберігає кілька чеків (списків товарів) однією транзакцією.
+# Повертає [(check_id, item_ids, duplicate), ...] у порядку вхідних даних. Чек із відбитком,
+# який уже є в базі, не записується: повертається ID наявного чека і duplicate=True.
+# Кількість запитів не залежить від кількості рядків: ID резервуються одним запитом,
+# вставка — через unnest(...).
+@timed_db_call
+async def save_checks_to_db(user_id, checks):
+    if not checks:
+        return []
+    fingerprints = [get_fingerprint(items) for items in checks]
+    existing = {
+        fp: _KNOWN_FINGERPRINTS[(user_id, fp)]
+        for fp in fingerprints if fp and (user_id, fp) in _KNOWN_FINGERPRINTS
+    }
+    async with get_pool().connection() as conn:
+        await apply_category_overrides(conn, user_id, checks)
+        async with conn.transaction():
+            unknown = [fp for fp in fingerprints if fp and fp not in existing]
+            if unknown:
+                existing.update(await find_checks_by_fingerprint(conn, user_id, unknown))
+            # Кеш — лише підказка: чек міг видалити інший процес. Товари дублікатів
+            # однаково читаються з бази, і цей же запит показує, чи чек ще існує.
+            duplicate_items = await get_item_ids(conn, user_id, set(existing.values())) if existing else {}
+            for fp, check_id in list(existing.items()):
+                if check_id not in duplicate_items:
+                    del existing[fp]
+                    _KNOWN_FINGERPRINTS.pop((user_id, fp), None)
+
+            new = [i for i, fp in enumerate(fingerprints) if fp not in existing]
+            if new:
+                inserted = await insert_checks(
+                    conn, user_id, [checks[i] for i in new], [fingerprints[i] for i in new]
+                )
+                # Чеки, які паралельно встиг записати інший запит (або повтор у цій же пачці)
+                lost = [fingerprints[i] for i, saved in zip(new, inserted) if saved is None]
+                if lost:
+                    found = await find_checks_by_fingerprint(conn, user_id, lost)
+                    existing.update(found)
+                    duplicate_items.update(await get_item_ids(conn, user_id, set(found.values())))
+            else:
+                inserted = []
+
+            result = [None] * len(checks)
+            for i, saved in zip(new, inserted):
+                if saved is not None:
+                    result[i] = (saved[0], saved[1], False)
+            for i, fp in enumerate(fingerprints):
+                if result[i] is None:
+                    check_id = existing[fp]
+                    result[i] = (check_id, duplicate_items.get(check_id, []), True)
+
+    for fp, (check_id, _, _) in zip(fingerprints, result):
+        if fp:
+            remember_fingerprint(user_id, fp, check_id)
+    report_cache.invalidate_dates(
+        user_id,
+        [item["date"] for items, (_, _, duplicate) in zip(checks, result) if not duplicate for item in items],
+    )
+    return result
+
+def cached_category_overrides(user_id, names):
+    # ({нормалізована назва: категорія} з кешу, назви, яких у кеші немає)
+    result = {}
+    missing = []
+    for name in set(names):
+        hit, category = override_cache.lookup(user_id, name)
+        if not hit:
+            missing.append(name)
+        elif category is not None:
+            result[name] = category
+    return result, missing
+
+async def resolve_category_overrides(conn, user_id, names):
+    # {нормалізована назва: категорія} для назв, які користувач виправляв; у базу йдуть
+    # лише назви, яких немає в кеші, і всі одним запитом
+    result, missing = cached_category_overrides(user_id, names)
+    if missing:
+        cur = await conn.execute(OVERRIDES_SQL, (user_id, missing), prepare=True)
+        found = {row["name"]: row["category"] for row in await cur.fetchall()}
+        for name in missing:
+            override_cache.put(user_id, name, found.get(name))
+        result.update(found)
+    return result
+
+def normalize_item_names(checks):
+    normalized = {item["name"]: None for items in checks for item in items}
+    for name in normalized:
+        normalized[name] = normalize_text(name)
+    return normalized
+
+def set_override_categories(checks, normalized, overrides):
+    for items in checks:
         for item in items:
-            cur.execute(
-                'INSERT INTO items (check_id, date, name, category, "sum") '
-                'VALUES (%s, %s, %s, %s, %s) RETURNING id',
-                (check_id, item["date"], item["name"], item["category"], item["sum"]),
-            )
-            item_ids.append(cur.fetchone()['id'])
-        conn.commit()
-        return check_id, item_ids
-    finally:
-        cur.close()
-        conn.close()
+            category = overrides.get(normalized[item["name"]])
+            if category is not None:
+                item["category"] = category
 
-def get_report(period, from_date=None, to_date=None):
-    conn = get_connection()
+async def apply_category_overrides(conn, user_id, checks):
+    # Виправлення користувача мають пріоритет над категорією, яку дав автомат при розборі
+    normalized = normalize_item_names(checks)
+    overrides = await resolve_category_overrides(conn, user_id, normalized.values())
+    if overrides:
+        set_override_categories(checks, normalized, overrides)
+
+async def apply_cached_overrides(user_id, checks, timeout=None):
+    # Для відповіді до запису чеків у базу (журнал): виправлення беруться з кешу, а назви, яких
+    # у кеші немає, шукаються в базі, лише якщо задано timeout (секунди на з'єднання). Якщо база
+    # не відповіла, знайдені в кеші виправлення все одно застосовуються, а помилка передається далі.
+    normalized = normalize_item_names(checks)
+    overrides, missing = cached_category_overrides(user_id, normalized.values())
     try:
-        cur = conn.cursor()
-        if period == "day":
-            cur.execute(
-                'SELECT category, SUM("sum") AS total FROM items '
-                'WHERE date = CURRENT_DATE GROUP BY category;'
-            )
-        elif period == "week":
-            cur.execute(
-                'SELECT category, SUM("sum") AS total FROM items '
-                'WHERE date >= CURRENT_DATE - INTERVAL \'7 days\' GROUP BY category;'
+        if missing and timeout is not None:
+            async with get_pool().connection(timeout=timeout) as conn:
+                overrides.update(await resolve_category_overrides(conn, user_id, missing))
+    finally:
+        if overrides:
+            set_override_categories(checks, normalized, overrides)
+
+async def get_category_overrides(user_id, names):
+    async with get_pool().connection() as conn:
+        return await resolve_category_overrides(conn, user_id, names)
+
+async def find_checks_by_fingerprint(conn, user_id, fingerprints):
+    cur = await conn.execute(FIND_FINGERPRINTS_SQL, (user_id, list(fingerprints)), prepare=True)
+    return {row["fingerprint"]: row["id"] for row in await cur.fetchall()}
+
+async def get_item_ids(conn, user_id, check_ids):
+    cur = await conn.execute(ITEM_IDS_SQL, (user_id, list(check_ids)), prepare=True)
+    return {row["check_id"]: row["ids"] for row in await cur.fetchall()}
+
+# Повертає для кожного чека (check_id, item_ids) або None, якщо чек із таким
+# відбитком уже існує і вставку пропущено.
+async def insert_checks(conn, user_id, checks, fingerprints):
+    total_items = sum(len(items) for items in checks)
+    cur = await conn.execute(RESERVE_IDS_SQL, (len(checks), total_items), prepare=True)
+    reserved = await cur.fetchone()
+    check_ids = sorted(reserved["check_ids"])
+    cur = await conn.execute(INSERT_CHECKS_SQL, (user_id, check_ids, fingerprints), prepare=True)
+    created = {row["id"] for row in await cur.fetchall()}
+
+    free_item_ids = iter(sorted(reserved["item_ids"]))
+    result = []
+    cols = {"id": [], "check_id": [], "date": [], "name": [], "category": [], "sum": []}
+    for check_id, items in zip(check_ids, checks):
+        if check_id not in created:
+            result.append(None)
+            continue
+        item_ids = []
+        for item in items:
+            item_id = next(free_item_ids)
+            item_ids.append(item_id)
+            cols["id"].append(item_id)
+            cols["check_id"].append(check_id)
+            cols["date"].append(item["date"])
+            cols["name"].append(item["name"])
+            cols["category"].append(item["category"])
+            cols["sum"].append(item["sum"])
+        result.append((check_id, item_ids))
+
+    if cols["id"]:
+        await conn.execute(
+            INSERT_ITEMS_SQL,
+            (user_id, cols["id"], cols["check_id"], cols["date"],
+             cols["name"], cols["category"], cols["sum"]),
+            prepare=True,
+        )
+        await conn.execute(
+            ROLLUP_ADD_SQL, (user_id, cols["date"], cols["category"], cols["sum"]), prepare=True
+        )
+    return result
+
+async def delete_items_where(conn, user_id, where, params):
+    # Повертає (кількість видалених товарів, дати, яких це торкнулось)
+    cur = await conn.execute(ROLLUP_DELETE_ITEMS_SQL.format(where=where), (user_id, *params), prepare=True)
+    row = await cur.fetchone()
+    dates = row["dates"] or []
+    if dates:
+        await conn.execute(
+            "DELETE FROM daily_category_totals "
+            "WHERE user_id = %s AND date = ANY(%s) AND items_count <= 0;",
+            (user_id, dates),
+        )
+    return row["count"], dates
+
+@timed_db_call
+async def rebuild_rollup():
+    # Повний перерахунок підсумків з items; запис у items на цей час блокується
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE items IN SHARE MODE;")
+            await conn.execute("DELETE FROM daily_category_totals;")
+            cur = await conn.execute(
+                "INSERT INTO daily_category_totals (user_id, date, category, total, items_count) "
+                'SELECT user_id, date, category, COALESCE(SUM("sum"), 0), COUNT(*) FROM items '
+                "WHERE date IS NOT NULL AND category IS NOT NULL "
+                "GROUP BY user_id, date, category;"
             )
-        elif period == "month":
-            cur.execute(
-                'SELECT category, SUM("sum") AS total FROM items '
-                'WHERE date >= date_trunc(\'month\', CURRENT_DATE) GROUP BY category;'
+            rows = cur.rowcount
+    report_cache.clear()
+    return rows
+
+@timed_db_call
+async def get_report(user_id, period, from_date=None, to_date=None):
+    key = report_cache.resolve_period(user_id, period, from_date, to_date)
+    data = report_cache.get(key)
+    if data is not None:
+        return dict(data)
+    token = report_cache.begin()
+    _, _, start, end = key
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(REPORT_SQL, (user_id, start, end), prepare=True)
+        rows = await cur.fetchall()
+    data = {row["category"]: row["total"] for row in rows}
+    report_cache.put(key, data, token)
+    return dict(data)
+
+TREND_UNITS = {"day": timedelta(days=1), "week": timedelta(days=7)}
+
+@timed_db_call
+async def get_trend(user_id, unit, buckets):
+    # Останні buckets відрізків (day/week), включно з поточним.
+    # Повертає [{"bucket", "category", "total", "delta"}, ...]; delta у першого відрізка — None
+    today = date.today()
+    end = today if unit == "day" else today - timedelta(days=today.weekday())
+    start = end - TREND_UNITS[unit] * (buckets - 1)
+    params = {"unit": unit, "user_id": user_id, "start": start, "end": today, "step": f"1 {unit}"}
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(TREND_SQL, params, prepare=True)
+        return await cur.fetchall()
+
+@timed_db_call
+async def get_check_page(user_id, check_id, size, after=None, before=None):
+    # Повертає (позиції сторінки за зростанням id, чи є ще позиції в напрямку читання)
+    if before is not None:
+        sql, cursor = CHECK_PAGE_BEFORE_SQL, before
+    else:
+        sql, cursor = CHECK_PAGE_AFTER_SQL, after or 0
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(sql, (user_id, check_id, cursor, size + 1), prepare=True)
+        rows = await cur.fetchall()
+    more = len(rows) > size
+    rows = rows[:size]
+    if before is not None:
+        rows.reverse()
+    return rows, more
+
+@timed_db_call
+async def get_check_total(user_id, check_id):
+    # (кількість позицій, сума) чека за тим, що зараз є в базі
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(CHECK_TOTAL_SQL, (user_id, check_id), prepare=True)
+        row = await cur.fetchone()
+    return row["count"], row["total"]
+
+async def iter_item_batches(user_id, start, end, batch_size):
+    # Серверний курсор: ні psycopg, ні бот не тримають у пам'яті більше однієї пачки.
+    # З'єднання пулу зайняте, доки споживач не дочитає (або не закриє генератор).
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor(name="export_items") as cur:
+                await cur.execute(EXPORT_ITEMS_SQL, (user_id, start, end))
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+
+@timed_db_call
+async def get_debug_info(user_id):
+    async with get_pool().connection() as conn:
+        cur = await conn.execute("SELECT COUNT(*) AS count FROM checks WHERE user_id = %s;", (user_id,))
+        checks = (await cur.fetchone())["count"]
+        cur = await conn.execute("SELECT COUNT(*) AS count FROM items WHERE user_id = %s;", (user_id,))
+        items = (await cur.fetchone())["count"]
+    return {
+        "checks": checks,
+        "items": items,
+        "pool": get_pool_stats(),
+        "report_cache": report_cache.get_stats(),
+        "override_cache": override_cache.get_stats(),
+    }
+
+@timed_db_call
+async def delete_check_by_id(user_id, check_id):
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            # Товари видаляються явно (а не каскадом), щоб відняти їх із підсумків
+            _, dates = await delete_items_where(conn, user_id, "check_id = %s", (check_id,))
+            cur = await conn.execute(
+                "DELETE FROM checks WHERE id = %s AND user_id = %s RETURNING id, fingerprint;",
+                (check_id, user_id),
             )
-        elif period == "custom" and from_date and to_date:
-            cur.execute(
-                'SELECT category, SUM("sum") AS total FROM items '
-                'WHERE date BETWEEN %s AND %s GROUP BY category;',
-                (from_date, to_date),
+            row = await cur.fetchone()
+    report_cache.invalidate_dates(user_id, dates)
+    if row is None:
+        return False
+    if row["fingerprint"]:
+        _KNOWN_FINGERPRINTS.pop((user_id, row["fingerprint"]), None)
+    return True
+
+@timed_db_call
+async def delete_item_by_id(user_id, item_id):
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            count, dates = await delete_items_where(conn, user_id, "id = %s", (item_id,))
+    report_cache.invalidate_dates(user_id, dates)
+    return count > 0
+
+@timed_db_call
+async def claim_legacy_data(user_id):
+    # Передає користувачу чеки й товари, збережені до появи user_id
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            await conn.execute("UPDATE checks SET user_id = %s WHERE user_id = 0;", (user_id,))
+            cur = await conn.execute("UPDATE items SET user_id = %s WHERE user_id = 0;", (user_id,))
+            moved = cur.rowcount
+    await rebuild_rollup()
+    return moved
+
+# === Стан діалогів ===
+
+@timed_db_call
+async def load_bot_state(user_id, chat_id, timeout=None):
+    # Повертає {(chat_id, name): data} для користувача: його user_data і стани діалогів у чаті.
+    # timeout — скільки чекати з'єднання (за замовчуванням POOL_TIMEOUT)
+    async with get_pool().connection(timeout=timeout) as conn:
+        cur = await conn.execute(LOAD_STATE_SQL, (user_id, chat_id), prepare=True)
+        rows = await cur.fetchall()
+    return {(row["chat_id"], row["name"]): row["data"] for row in rows}
+
+# saved: {(user_id, chat_id, name): JSON-рядок}, deleted: [(user_id, chat_id, name), ...]
+@timed_db_call
+async def save_bot_state(saved, deleted):
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            if saved:
+                keys = list(saved)
+                await conn.execute(
+                    SAVE_STATE_SQL,
+                    (
+                        [key[0] for key in keys],
+                        [key[1] for key in keys],
+                        [key[2] for key in keys],
+                        [saved[key] for key in keys],
+                    ),
+                    prepare=True,
+                )
+            if deleted:
+                await conn.execute(
+                    DELETE_STATE_SQL,
+                    ([key[0] for key in deleted], [key[1] for key in deleted], [key[2] for key in deleted]),
+                    prepare=True,
+                )
+
+# === Фонові роботи ===
+
+async def get_job_checkpoint(name):
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(
+            "SELECT version, last_id, finished FROM job_checkpoints WHERE name = %s;", (name,)
+        )
+        return await cur.fetchone()
+
+async def get_items_after(last_id, limit):
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(ITEMS_AFTER_SQL, (last_id, limit), prepare=True)
+        return await cur.fetchall()
+
+# Застосовує нові категорії пачки товарів і пересуває контрольну точку роботи в одній
+# транзакції. expected — стан точки (version, last_id), від якого рахувалась пачка, або
+# None, якщо точки ще не було: якщо інший процес тим часом її посунув, нічого не змінюється
+# і повертається None. Так само None, якщо точку записано за новішою версією правил: процес
+# зі старими правилами не повертає товари на старі категорії. Інакше — кількість змінених
+# товарів. changes: [(item_id, category), ...]
+@timed_db_call
+async def recategorize_items(job, expected, version, last_id, changes, finished=False):
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            cur = await conn.execute(
+                "SELECT version, last_id FROM job_checkpoints WHERE name = %s FOR UPDATE;", (job,)
             )
-        else:
-            cur.execute(
-                'SELECT category, SUM("sum") AS total FROM items GROUP BY category;'
+            row = await cur.fetchone()
+            if row and row["version"] > version:
+                return None
+            if ((row["version"], row["last_id"]) if row else None) != expected:
+                return None
+            moved, touched = await move_items_category(conn, changes)
+            await conn.execute(
+                "INSERT INTO job_checkpoints (name, version, last_id, finished) VALUES (%s, %s, %s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version, last_id = EXCLUDED.last_id, "
+                "finished = EXCLUDED.finished, updated_at = now();",
+                (job, version, last_id, finished),
             )
-        rows = cur.fetchall()
-        return {row["category"]: row["total"] for row in rows}
-    finally:
-        cur.close()
-        conn.close()
+    for user_id, dates in touched.items():
+        report_cache.invalidate_dates(user_id, dates)
+    return moved
 
-def get_debug_info():
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) AS count FROM checks;")
-        checks = cur.fetchone()["count"]
-        cur.execute("SELECT COUNT(*) AS count FROM items;")
-        items = cur.fetchone()["count"]
-        return {"checks": checks, "items": items}
-    finally:
-        cur.close()
-        conn.close()
+async def move_items_category(conn, changes):
+    # Змінює категорії товарів разом із денними підсумками. changes: [(item_id, category), ...]
+    # Повертає (кількість змінених товарів, {user_id: {дати}})
+    if not changes:
+        return 0, {}
+    cur = await conn.execute(
+        RECATEGORIZE_SQL, ([c[0] for c in changes], [c[1] for c in changes]), prepare=True
+    )
+    moved = await cur.fetchall()
+    touched = {}
+    if moved:
+        users = [m["user_id"] for m in moved]
+        dates = [m["date"] for m in moved]
+        sums = [m["sum"] for m in moved]
+        await conn.execute(ROLLUP_SUBTRACT_MANY_SQL, (users, dates, [m["old_category"] for m in moved], sums))
+        await conn.execute(ROLLUP_ADD_MANY_SQL, (users, dates, [m["new_category"] for m in moved], sums))
+        await conn.execute(ROLLUP_CLEANUP_MANY_SQL, (users, dates))
+        for m in moved:
+            touched.setdefault(m["user_id"], set()).add(m["date"])
+    return len(moved), touched
 
-def delete_check_by_id(check_id):
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM checks WHERE id = %s RETURNING id;", (check_id,))
-        deleted = cur.fetchone() is not None
-        conn.commit()
-        return deleted
-    finally:
-        cur.close()
-        conn.close()
+async def get_item(user_id, item_id):
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(
+            "SELECT id, name, category FROM items WHERE id = %s AND user_id = %s;", (item_id, user_id)
+        )
+        return await cur.fetchone()
 
-def delete_item_by_id(item_id):
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM items WHERE id = %s RETURNING id;", (item_id,))
-        deleted = cur.fetchone() is not None
-        conn.commit()
-        return deleted
-    finally:
-        cur.close()
-        conn.close()
+@timed_db_call
+async def set_category_override(user_id, item_id, category):
+    # Запам'ятовує категорію для назви товару і застосовує її до всіх товарів користувача
+    # з такою самою нормалізованою назвою (як і для нових чеків). Повертає кількість змінених товарів або None, якщо товару немає.
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            cur = await conn.execute(
+                "SELECT name FROM items WHERE id = %s AND user_id = %s;", (item_id, user_id)
+            )
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            normalized = normalize_text(row["name"])
+            await conn.execute(
+                "INSERT INTO category_overrides (user_id, name, category) VALUES (%s, %s, %s) "
+                "ON CONFLICT (user_id, name) DO UPDATE SET category = EXCLUDED.category, updated_at = now();",
+                (user_id, normalized, category),
+            )
+            # Нормалізація є лише в Python: вибираємо різні назви користувача і порівнюємо тут
+            cur = await conn.execute("SELECT DISTINCT name FROM items WHERE user_id = %s;", (user_id,))
+            names = [r["name"] for r in await cur.fetchall() if normalize_text(r["name"]) == normalized]
+            cur = await conn.execute(
+                "SELECT id FROM items WHERE user_id = %s AND name = ANY(%s::text[]);", (user_id, names)
+            )
+            changes = [(r["id"], category) for r in await cur.fetchall()]
+            moved, touched = await move_items_category(conn, changes)
+    override_cache.put(user_id, normalized, category)
+    report_cache.invalidate_dates(user_id, touched.get(user_id, ()))
+    return moved
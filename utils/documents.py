@@ -0,0 +1,26 @@
+import os
+import tempfile
+from io import BytesIO
+from contextlib import asynccontextmanager
+
+# Документи до цього розміру завантажуються в пам'ять, більші — у тимчасовий файл
+DOCUMENT_MEMORY_LIMIT = int(os.getenv("DOCUMENT_MEMORY_LIMIT", str(4 * 1024 * 1024)))
+# Каталог для тимчасових файлів великих документів (за замовчуванням — системний)
+DOCUMENT_SPOOL_DIR = os.getenv("DOCUMENT_SPOOL_DIR") or None
+
+@asynccontextmanager
+async def open_document(document):
+    # Дає джерело для парсера: BytesIO із вмістом документа або шлях до тимчасового
+    # файлу. Тимчасовий файл видаляється на виході з блоку, навіть якщо розбір упав.
+    file = await document.get_file()
+    size = document.file_size or file.file_size or 0
+    if size <= DOCUMENT_MEMORY_LIMIT:
+        buffer = BytesIO()
+        await file.download_to_memory(buffer)
+        buffer.seek(0)
+        yield buffer
+        return
+    suffix = os.path.splitext(document.file_name or "")[1]
+    with tempfile.NamedTemporaryFile(dir=DOCUMENT_SPOOL_DIR, suffix=suffix) as tmp:
+        await file.download_to_drive(tmp.name)
+        yield tmp.name
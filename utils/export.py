@@ -0,0 +1,45 @@
+import os
+import csv
+from io import StringIO
+
+import orjson
+
+from utils.db import iter_item_batches
+
+# Скільки рядків читати з курсора за раз
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Токен для HTTP-експорту (заголовок Authorization: Bearer ...); без нього маршрут вимкнено
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+}
+EXPORT_COLUMNS = ("date", "name", "category", "sum", "check_id")
+
+def export_header(fmt):
+    if fmt == "csv":
+        out = StringIO()
+        csv.writer(out, lineterminator="\n").writerow(EXPORT_COLUMNS)
+        return out.getvalue().encode("utf-8")
+    return b""
+
+async def export_items(user_id, start, end, fmt):
+    # Віддає файл експорту шматками байтів: заголовок і по одному шматку на пачку рядків
+    header = export_header(fmt)
+    if header:
+        yield header
+    async for rows in iter_item_batches(user_id, start, end, EXPORT_BATCH_SIZE):
+        yield format_csv(rows) if fmt == "csv" else format_jsonl(rows)
+
+def format_csv(rows):
+    out = StringIO()
+    csv.writer(out, lineterminator="\n").writerows(
+        (row["date"].isoformat(), row["name"], row["category"], f"{row['sum'] / 100:.2f}", row["check_id"])
+        for row in rows
+    )
+    return out.getvalue().encode("utf-8")
+
+def format_jsonl(rows):
+    # orjson серіалізує date як YYYY-MM-DD; сума — у гривнях, як у звітах
+    return b"".join(orjson.dumps(dict(row, sum=row["sum"] / 100)) + b"\n" for row in rows)
@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+import aiohttp
+from lxml import etree
+
+from parsers.xml_parser import ReceiptPullParser
+
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "10"))
+FETCH_MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", "100"))
+FETCH_LIMIT_PER_HOST = int(os.getenv("FETCH_LIMIT_PER_HOST", "8"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "32"))
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(5 * 1024 * 1024)))
+FETCH_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+SESSION = None
+_FETCH_SLOTS = None
+
+@dataclass
+class FetchResult:
+    url: str
+    items: list = field(default_factory=list)
+    error: str = None
+    status: int = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+async def init_http():
+    global SESSION, _FETCH_SLOTS
+    connector = aiohttp.TCPConnector(limit=FETCH_MAX_CONNECTIONS, limit_per_host=FETCH_LIMIT_PER_HOST)
+    SESSION = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+        raise_for_status=False,
+    )
+    _FETCH_SLOTS = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+async def close_http():
+    global SESSION
+    if SESSION is not None:
+        await SESSION.close()
+        SESSION = None
+
+def get_session():
+    if SESSION is None:
+        raise RuntimeError("HTTP-клієнт не ініціалізовано! Викличте init_http().")
+    return SESSION
+
+async def fetch_receipt(url):
+    session = get_session()
+    async with _FETCH_SLOTS:
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return FetchResult(url, error="http_status", status=response.status)
+                if response.content_length and response.content_length > FETCH_MAX_BYTES:
+                    return FetchResult(url, error="too_large", status=response.status)
+                # Тіло не збирається в пам'яті: кожен шматок одразу йде в парсер
+                parser = ReceiptPullParser()
+                items = []
+                received = 0
+                # ValueError тут — некоректні числа в самому чеку (COST, SM), а не посилання
+                try:
+                    async for chunk in response.content.iter_chunked(FETCH_CHUNK_SIZE):
+                        received += len(chunk)
+                        if received > FETCH_MAX_BYTES:
+                            return FetchResult(url, error="too_large", status=response.status)
+                        items.extend(parser.feed(chunk))
+                        if parser.unsupported:
+                            return FetchResult(url, error="unsupported_format", status=response.status)
+                    items.extend(parser.close())
+                except ValueError:
+                    return FetchResult(url, error="invalid_receipt", status=response.status)
+                if parser.unsupported:
+                    return FetchResult(url, error="unsupported_format", status=response.status)
+                return FetchResult(url, items=items, status=response.status)
+        except asyncio.TimeoutError:
+            return FetchResult(url, error="timeout")
+        except etree.XMLSyntaxError:
+            return FetchResult(url, error="invalid_xml")
+        except (aiohttp.InvalidURL, ValueError):
+            return FetchResult(url, error="invalid_url")
+        except aiohttp.ClientError as e:
+            logger.warning(f"Не вдалося завантажити {url}: {e}")
+            return FetchResult(url, error="network")
+
+async def fetch_receipts(urls):
+    return await asyncio.gather(*(fetch_receipt(url) for url in urls))
@@ -0,0 +1,344 @@
+import os
+import uuid
+import fcntl
+import asyncio
+import logging
+from collections import deque
+from datetime import date
+from itertools import islice
+
+import orjson
+from psycopg import DataError, IntegrityError
+
+from utils.db import ITEM_SUM_MAX, save_checks_to_db
+from utils.metrics import JOURNAL_DEAD_LETTERS
+
+logger = logging.getLogger(__name__)
+
+# Каталог локального журналу чеків; без нього чеки пишуться прямо в базу.
+# Кожен процес бота має власний каталог (його захищає lock-файл).
+JOURNAL_DIR = os.getenv("JOURNAL_DIR") or None
+# Після якого розміру (байти) журнал переходить на новий сегмент
+JOURNAL_SEGMENT_SIZE = int(os.getenv("JOURNAL_SEGMENT_SIZE", str(16 * 1024 * 1024)))
+# Скільки чеків переносити в базу за один прохід і скільки чекати, поки збереться пачка (секунди)
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "500"))
+JOURNAL_FLUSH_DELAY = float(os.getenv("JOURNAL_FLUSH_DELAY", "0.2"))
+# Найдовша пауза між спробами, поки база недоступна
+JOURNAL_RETRY_MAX = float(os.getenv("JOURNAL_RETRY_MAX", "30"))
+# Після стількох відмов бази через дані (не через недоступність) запис іде в dead-letter
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "3"))
+# Скільки при зупинці чекати, поки журнал спорожніє; решта залишиться на диску до наступного запуску
+JOURNAL_DRAIN_TIMEOUT = float(os.getenv("JOURNAL_DRAIN_TIMEOUT", "10"))
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_FILE = "checkpoint"
+LOCK_FILE = "lock"
+DEAD_LETTER_FILE = "dead-letter.log"
+
+# Помилки, які повтор не виправить: у записі щось, чого база не прийме. Проблеми схеми
+# чи прав (ProgrammingError) сюди не входять — їх виправляють у базі, і запис повторюється
+DATA_ERRORS = (DataError, IntegrityError, ValueError, TypeError, KeyError)
+
+_lock = None
+_segment = None
+_segment_seq = 0
+_segment_size = 0
+# Записані на диск, але ще не перенесені в базу: (user_id, checks, (сегмент, кінець запису))
+_records = deque()
+# Чекають на запис у журнал: (user_id, checks, рядок, future)
+_appends = []
+_write_wakeup = None
+_flush_wakeup = None
+_tasks = []
+# Позиція запису -> скільки разів база відхилила його через дані
+_attempts = {}
+_dead = 0
+
+def journal_enabled():
+    return _segment is not None
+
+def get_journal_stats():
+    return {"pending": len(_records), "segment": _segment_seq, "dead": _dead} if journal_enabled() else None
+
+def get_pending():
+    return len(_records)
+
+def segment_path(seq):
+    return os.path.join(JOURNAL_DIR, f"{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}")
+
+def list_segments():
+    seqs = []
+    for name in os.listdir(JOURNAL_DIR):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            seqs.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+    return sorted(seqs)
+
+# === Запуск і зупинка ===
+
+def init_journal():
+    global _lock, _segment, _segment_seq, _segment_size, _write_wakeup, _flush_wakeup
+    if not JOURNAL_DIR:
+        return
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    _lock = open(os.path.join(JOURNAL_DIR, LOCK_FILE), "w")
+    try:
+        fcntl.flock(_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        _lock.close()
+        _lock = None
+        raise RuntimeError(f"Журнал {JOURNAL_DIR} уже використовує інший процес")
+    checkpoint = load_checkpoint()
+    segments = list_segments()
+    for seq in segments:
+        if seq < checkpoint[0]:
+            os.remove(segment_path(seq))
+        else:
+            _records.extend(read_segment(seq, checkpoint[1] if seq == checkpoint[0] else 0))
+    # Дописуємо завжди в новий сегмент: хвіст старого міг обірватися посеред запису
+    _segment_seq = max(segments + [checkpoint[0]]) + 1
+    _segment = open(segment_path(_segment_seq), "ab")
+    _segment_size = 0
+    _write_wakeup = asyncio.Event()
+    _flush_wakeup = asyncio.Event()
+    _tasks.append(asyncio.create_task(write_loop()))
+    _tasks.append(asyncio.create_task(flush_loop()))
+    if _records:
+        logger.info(f"♻️ У журналі {len(_records)} незбережених записів, переносимо в базу")
+        _flush_wakeup.set()
+
+async def close_journal():
+    global _lock, _segment
+    if not journal_enabled():
+        return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + JOURNAL_DRAIN_TIMEOUT
+    while (_records or _appends) and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    if _records:
+        logger.warning(f"⚠️ У журналі залишилось {len(_records)} записів — їх буде перенесено після запуску")
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    _records.clear()
+    _attempts.clear()
+    _segment.close()
+    _segment = None
+    _lock.close()
+    _lock = None
+
+def load_checkpoint():
+    # (сегмент, зміщення), до якого всі записи вже в базі
+    try:
+        with open(os.path.join(JOURNAL_DIR, CHECKPOINT_FILE), "rb") as f:
+            data = orjson.loads(f.read())
+        return data["segment"], data["offset"]
+    except FileNotFoundError:
+        return 0, 0
+
+def save_checkpoint(position):
+    path = os.path.join(JOURNAL_DIR, CHECKPOINT_FILE)
+    with open(path + ".tmp", "wb") as f:
+        f.write(orjson.dumps({"segment": position[0], "offset": position[1]}))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    for seq in list_segments():
+        if seq < position[0]:
+            os.remove(segment_path(seq))
+
+def read_segment(seq, offset):
+    records = []
+    with open(segment_path(seq), "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    position = offset
+    for line in data.splitlines(keepends=True):
+        position += len(line)
+        if not line.endswith(b"\n"):
+            logger.warning(f"⚠️ Обірваний запис у кінці {segment_path(seq)} пропущено")
+            break
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            logger.warning(f"⚠️ Пошкоджений запис у {segment_path(seq)} пропущено")
+            continue
+        records.append((record["user_id"], record["checks"], (seq, position)))
+    return records
+
+# === Запис ===
+
+def validate_checks(checks):
+    # Те, що база гарантовано відхилить, не приймається в журнал: інакше користувач
+    # отримав би «прийнято», а чек так і не потрапив би в базу
+    for items in checks:
+        for item in items:
+            name = item.get("name")
+            if not isinstance(name, str) or not name:
+                raise ValueError("товар без назви")
+            if not isinstance(item.get("category"), str):
+                raise ValueError(f"товар «{name[:50]}» без категорії")
+            total = item.get("sum")
+            if not isinstance(total, int) or isinstance(total, bool) or abs(total) > ITEM_SUM_MAX:
+                raise ValueError(f"некоректна сума товару «{name[:50]}»")
+            try:
+                date.fromisoformat(item["date"])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"некоректна дата товару «{name[:50]}»")
+
+async def append_checks(user_id, checks):
+    # Повертається, коли чеки надійно записані на диск (fsync). Чеки без відбитка отримують
+    # випадковий: повторний перенос того самого запису в базу не створить дубля.
+    # ValueError — якщо чек некоректний; тоді в журнал нічого не пишеться.
+    validate_checks(checks)
+    for items in checks:
+        if items and not items[0].get("fingerprint"):
+            fingerprint = f"journal:{uuid.uuid4().hex}"
+            for item in items:
+                item["fingerprint"] = fingerprint
+    line = orjson.dumps({"user_id": user_id, "checks": checks}) + b"\n"
+    future = asyncio.get_running_loop().create_future()
+    _appends.append((user_id, checks, line, future))
+    _write_wakeup.set()
+    await future
+
+async def write_loop():
+    # Групова фіксація: усі записи, що надійшли за час попереднього fsync, пишуться разом
+    global _appends
+    while True:
+        await _write_wakeup.wait()
+        _write_wakeup.clear()
+        batch, _appends = _appends, []
+        if not batch:
+            continue
+        try:
+            positions = await asyncio.to_thread(write_lines, [line for _, _, line, _ in batch])
+        except Exception as e:
+            logger.error(f"❌ Не вдалося записати в журнал: {e}")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (user_id, checks, _, future), position in zip(batch, positions):
+            _records.append((user_id, checks, position))
+            if not future.done():
+                future.set_result(None)
+        _flush_wakeup.set()
+
+def write_lines(lines):
+    global _segment, _segment_seq, _segment_size
+    if _segment_size >= JOURNAL_SEGMENT_SIZE:
+        _segment.close()
+        _segment_seq += 1
+        _segment = open(segment_path(_segment_seq), "ab")
+        _segment_size = 0
+    positions = []
+    for line in lines:
+        _segment_size += len(line)
+        positions.append((_segment_seq, _segment_size))
+    _segment.write(b"".join(lines))
+    _segment.flush()
+    os.fsync(_segment.fileno())
+    return positions
+
+# === Перенесення в базу ===
+
+async def flush_loop():
+    delay = 1
+    while True:
+        await _flush_wakeup.wait()
+        _flush_wakeup.clear()
+        # Даємо зібратися пачці: сплеск завантажень стає кількома великими транзакціями
+        await asyncio.sleep(JOURNAL_FLUSH_DELAY)
+        while _records:
+            batch = list(islice(_records, JOURNAL_BATCH_SIZE))
+            try:
+                await flush_batch(batch)
+                done = len(batch)
+            except Exception as e:
+                # Пачка не пройшла: переносимо записи по одному, щоб один поганий запис
+                # не тримав усі наступні
+                logger.warning(f"⚠️ Журнал: пачка з {len(batch)} записів не збереглась, переносимо по одному: {e}")
+                done = await flush_one_by_one(batch)
+            if done:
+                for _ in range(done):
+                    _records.popleft()
+                await asyncio.to_thread(save_checkpoint, batch[done - 1][2])
+            if done < len(batch):
+                logger.error(f"❌ Журнал: {len(_records)} записів чекають, повтор через {delay} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, JOURNAL_RETRY_MAX)
+            else:
+                delay = 1
+
+async def flush_one_by_one(batch):
+    # Повертає, скільки записів з початку пачки оброблено: збережено або відкладено в dead-letter.
+    # Недоступна база зупиняє прохід одразу; відмова через дані — після JOURNAL_MAX_ATTEMPTS спроб.
+    global _dead
+    for done, (user_id, checks, position) in enumerate(batch):
+        try:
+            await save_checks_to_db(user_id, checks)
+        except DATA_ERRORS as e:
+            attempts = _attempts.get(position, 0) + 1
+            if attempts < JOURNAL_MAX_ATTEMPTS:
+                _attempts[position] = attempts
+                logger.error(f"❌ Журнал: база відхилила запис користувача {user_id} (спроба {attempts}): {e}")
+                return done
+            _attempts.pop(position, None)
+            await asyncio.to_thread(write_dead_letter, user_id, checks, position, e)
+            _dead += 1
+            JOURNAL_DEAD_LETTERS.inc()
+            logger.error(f"☠️ Журнал: запис користувача {user_id} перенесено в {DEAD_LETTER_FILE}: {e}")
+        except Exception as e:
+            logger.error(f"❌ Журнал: база недоступна або не готова: {e}")
+            return done
+        else:
+            _attempts.pop(position, None)
+    return len(batch)
+
+def write_dead_letter(user_id, checks, position, error):
+    record = {"user_id": user_id, "checks": checks, "position": position, "error": str(error)}
+    with open(os.path.join(JOURNAL_DIR, DEAD_LETTER_FILE), "ab") as f:
+        f.write(orjson.dumps(record) + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+async def replay_dead_letters():
+    # Повторно зберігає відкладені записи, коли причину відмови усунуто (manage.py replay-dead-letters).
+    # Файл спершу переноситься убік, тож бот, що працює, далі дописує в новий dead-letter.log;
+    # записи, які знову не збереглися, повертаються туди. Повтор безпечний: уже збережені
+    # чеки знайдуться за відбитками. Повертає (збережено, залишилось).
+    path = os.path.join(JOURNAL_DIR, DEAD_LETTER_FILE)
+    replay = path + ".replay"
+    # Файл, що залишився від перерваного повтору, обробляється першим
+    if not os.path.exists(replay):
+        try:
+            os.replace(path, replay)
+        except FileNotFoundError:
+            return 0, 0
+    with open(replay, "rb") as f:
+        lines = f.read().splitlines()
+    saved = failed = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        try:
+            await save_checks_to_db(record["user_id"], record["checks"])
+            saved += 1
+        except Exception as e:
+            failed += 1
+            logger.error(f"❌ Запис користувача {record['user_id']} знову не збережено: {e}")
+            await asyncio.to_thread(write_dead_letter, record["user_id"], record["checks"], record.get("position"), e)
+    os.remove(replay)
+    return saved, failed
+
+async def flush_batch(batch):
+    # Одна транзакція на користувача в пачці. Якщо частина пачки вже записана, а решта впала,
+    # повтор усієї пачки безпечний: записані чеки знайдуться за відбитками
+    by_user = {}
+    for user_id, checks, _ in batch:
+        by_user.setdefault(user_id, []).extend(checks)
+    for user_id, checks in by_user.items():
+        await save_checks_to_db(user_id, checks)
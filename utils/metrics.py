@@ -0,0 +1,62 @@
+import time
+from functools import wraps
+
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Час виконання обробників Telegram", ["handler"],
+)
+HANDLER_FAILURES = Counter(
+    "bot_handler_failures_total", "Обробники, що завершились винятком", ["handler"],
+)
+DB_LATENCY = Histogram(
+    "bot_db_call_seconds", "Час викликів utils/db.py", ["call"],
+)
+PARSE_LATENCY = Histogram(
+    "bot_parse_seconds", "Час розбору і категоризації чека (без очікування в черзі)", ["parser"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+UPDATE_QUEUE_DEPTH = Gauge(
+    "bot_update_queue_depth", "Прийняті вебхуком оновлення, що чекають на обробку або обробляються",
+)
+JOURNAL_PENDING = Gauge(
+    "bot_journal_pending", "Чеки в локальному журналі, ще не перенесені в базу",
+)
+JOURNAL_DEAD_LETTERS = Counter(
+    "bot_journal_dead_letters_total", "Записи журналу, які база постійно відхиляла і які відкладено в dead-letter",
+)
+WEBHOOK_REQUESTS = Counter(
+    "bot_webhook_requests_total", "Запити на вебхук", ["status"],
+)
+ERRORS = Counter(
+    "bot_errors_total", "Винятки, що дійшли до error_handler", ["error"],
+)
+
+def timed_handler(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            HANDLER_FAILURES.labels(fn.__name__).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(fn.__name__).observe(time.perf_counter() - started)
+    return wrapper
+
+def timed_db_call(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            DB_LATENCY.labels(fn.__name__).observe(time.perf_counter() - started)
+    return wrapper
+
+def observe_parse(parser, seconds):
+    PARSE_LATENCY.labels(parser).observe(seconds)
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,37 @@
+import os
+import time
+from collections import OrderedDict
+
+# Кеш виправлень категорій користувачів: (user_id, нормалізована назва) -> категорія або None.
+# None теж кешується: більшість назв виправлень не мають, і їх не треба шукати в базі щоразу.
+OVERRIDE_CACHE_SIZE = int(os.getenv("OVERRIDE_CACHE_SIZE", "50000"))
+# Страховка для кількох процесів: виправлення, зроблене в іншому процесі, стане видно не пізніше
+OVERRIDE_CACHE_TTL = float(os.getenv("OVERRIDE_CACHE_TTL", "300"))
+
+_CACHE = OrderedDict()
+_hits = 0
+_misses = 0
+
+def lookup(user_id, name):
+    # Повертає (знайдено в кеші, категорія або None)
+    global _hits, _misses
+    key = (user_id, name)
+    entry = _CACHE.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        _CACHE.move_to_end(key)
+        _hits += 1
+        return True, entry[1]
+    if entry is not None:
+        del _CACHE[key]
+    _misses += 1
+    return False, None
+
+def put(user_id, name, category):
+    key = (user_id, name)
+    _CACHE[key] = (time.monotonic() + OVERRIDE_CACHE_TTL, category)
+    _CACHE.move_to_end(key)
+    if len(_CACHE) > OVERRIDE_CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+def get_stats():
+    return {"size": len(_CACHE), "hits": _hits, "misses": _misses}
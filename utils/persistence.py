@@ -0,0 +1,166 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+
+import orjson
+from telegram.ext import BasePersistence, PersistenceInput
+
+from utils.db import load_bot_state, save_bot_state
+
+logger = logging.getLogger(__name__)
+
+# Як часто PTB передає змінені дані в persistence; буфер скидається в базу після кожного такого проходу
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "1"))
+# Скільки останніх прочитаних/записаних значень пам'ятати, щоб не переписувати незмінений стан
+PERSISTENCE_CACHE_SIZE = int(os.getenv("PERSISTENCE_CACHE_SIZE", "10000"))
+
+USER_DATA = "user_data"
+_UNKNOWN = object()
+
+def dump_state(value):
+    # Ключі сортуються: jsonb у базі не зберігає їх порядок, а рядки порівнюються напряму
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS).decode()
+
+class DbPersistence(BasePersistence):
+    # Стан діалогів і user_data в таблиці bot_state, спільний для кількох процесів бота.
+    # Стандартно PTB читає весь стан під час старту і далі живе з копією в пам'яті; тут get_*
+    # повертають порожні словники, а стан одного користувача в одному чаті читається перед
+    # кожним оновленням (load_state). Зміни не пишуться одразу: вони збираються в буфері
+    # й скидаються в базу однією транзакцією.
+
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        # (user_id, chat_id, name) -> JSON-рядок або None (видалити)
+        self._pending = {}
+        # Пачка, яка саме записується в базу
+        self._flushing = {}
+        # Останнє значення, відоме базі, у тому ж вигляді
+        self._persisted = OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    # === Читання ===
+
+    async def load_state(self, user_id, chat_id, names, timeout=None):
+        # Повертає (user_data, {name: стан діалогу або None}); ще не записані зміни цього
+        # процесу (у буфері або в пачці, що пишеться під час читання) новіші за базу
+        flushing = dict(self._flushing)
+        rows = await load_bot_state(user_id, chat_id, timeout)
+        wanted = [(user_id, 0, USER_DATA)] + [(user_id, chat_id, name) for name in names]
+        values = {}
+        for key in wanted:
+            if key in self._pending or key in flushing:
+                local = self._pending[key] if key in self._pending else flushing[key]
+                values[key[2]] = orjson.loads(local) if local is not None else None
+                continue
+            data = rows.get(key[1:])
+            self._remember(key, dump_state(data) if data is not None else None)
+            values[key[2]] = data
+        user_data = values.pop(USER_DATA) or {}
+        return user_data, values
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    # Стан підвантажується один раз на оновлення в load_state, а не перед кожним обробником
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # === Запис ===
+
+    async def update_user_data(self, user_id, data):
+        self._stage((user_id, 0, USER_DATA), data or None)
+
+    async def drop_user_data(self, user_id):
+        self._stage((user_id, 0, USER_DATA), None)
+
+    async def update_conversation(self, name, key, new_state):
+        # Ключ діалогу — (chat_id, user_id): у всіх наших ConversationHandler per_chat і per_user
+        chat_id, user_id = key
+        self._stage((user_id, chat_id, name), new_state)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    def _stage(self, key, value):
+        data = dump_state(value) if value is not None else None
+        # Пропускаємо лише значення, яке вже в базі і не перезапишеться пачкою, що саме пишеться:
+        # інакше повернення стану A→B→A під час запису B залишило б у базі B
+        if key not in self._pending and key not in self._flushing and self._persisted.get(key, _UNKNOWN) == data:
+            return
+        self._pending[key] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    def _remember(self, key, data):
+        self._persisted[key] = data
+        self._persisted.move_to_end(key)
+        if len(self._persisted) > PERSISTENCE_CACHE_SIZE:
+            self._persisted.popitem(last=False)
+
+    async def _flush_loop(self):
+        # Скидає буфер, доки в ньому щось є; після помилки повторює через update_interval
+        while self._pending:
+            if not await self.flush():
+                await asyncio.sleep(self.update_interval)
+
+    async def flush(self):
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return True
+            self._flushing = pending
+            saved = {key: data for key, data in pending.items() if data is not None}
+            deleted = [key for key, data in pending.items() if data is None]
+            try:
+                await save_bot_state(saved, deleted)
+            except Exception as e:
+                logger.error(f"❌ Не вдалося зберегти стан діалогів: {e}")
+                # Зміни, що надійшли під час спроби, новіші за повернуті в буфер
+                for key, data in pending.items():
+                    self._pending.setdefault(key, data)
+                return False
+            finally:
+                self._flushing = {}
+            for key, data in pending.items():
+                self._remember(key, data)
+            return True
+
+def apply_conversation_state(handler, key, state):
+    # Підставляє стан діалогу, прочитаний з бази, не позначаючи його як змінений
+    # (інакше PTB записав би його назад при наступному update_persistence)
+    if state is None:
+        handler._conversations.data.pop(key, None)
+    else:
+        handler._conversations.update_no_track({key: state})
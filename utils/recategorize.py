@@ -0,0 +1,103 @@
+import os
+import asyncio
+import logging
+
+from utils.categories import CATEGORY_RULES_POLL, categorize_many, get_rules_version, maybe_reload_rules, normalize_text
+from utils.db import get_job_checkpoint, get_items_after, recategorize_items, get_pool_stats, get_category_overrides
+
+logger = logging.getLogger(__name__)
+
+JOB_NAME = "recategorize"
+# Товарів за одну транзакцію і пауза між пачками (секунди), щоб не заважати живим запитам
+RECATEGORIZE_BATCH_SIZE = int(os.getenv("RECATEGORIZE_BATCH_SIZE", "1000"))
+RECATEGORIZE_PAUSE = float(os.getenv("RECATEGORIZE_PAUSE", "0.5"))
+
+_TASK = None
+# Версія правил, для якої робота вже завершена в цьому процесі (щоб не питати базу щоразу)
+_finished_version = None
+
+def start_recategorizer():
+    global _TASK
+    _TASK = asyncio.create_task(watch_rules())
+
+async def stop_recategorizer():
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        try:
+            await _TASK
+        except asyncio.CancelledError:
+            pass
+        _TASK = None
+
+async def watch_rules():
+    # Стежить за файлом правил і після зміни версії переводить збережені товари на нові правила
+    while True:
+        maybe_reload_rules()
+        try:
+            await run_recategorize()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Перекатегоризація перервана: {e}")
+        await asyncio.sleep(CATEGORY_RULES_POLL)
+
+async def wait_for_idle_pool():
+    # Поки до пулу є черга, пропускаємо живі запити вперед
+    while get_pool_stats()["waiting"] > 0:
+        await asyncio.sleep(RECATEGORIZE_PAUSE)
+
+async def categorize_rows(rows):
+    # Автомат для всіх назв, потім виправлення користувачів — по запиту на користувача в пачці
+    categories = categorize_many(row["name"] for row in rows)
+    by_user = {}
+    for i, row in enumerate(rows):
+        by_user.setdefault(row["user_id"], []).append(i)
+    for user_id, indexes in by_user.items():
+        names = {i: normalize_text(rows[i]["name"]) for i in indexes}
+        overrides = await get_category_overrides(user_id, names.values())
+        for i, name in names.items():
+            if name in overrides:
+                categories[i] = overrides[name]
+    return categories
+
+async def run_recategorize(pause=RECATEGORIZE_PAUSE):
+    # Проходить items пачками за id від контрольної точки. Повертає кількість змінених товарів.
+    # Кілька процесів можуть запускати роботу одночасно: пачку застосовує той, хто першим
+    # посунув контрольну точку, решта зупиняються до наступної перевірки.
+    global _finished_version
+    version = get_rules_version()
+    if _finished_version == version:
+        return 0
+    checkpoint = await get_job_checkpoint(JOB_NAME)
+    expected = (checkpoint["version"], checkpoint["last_id"]) if checkpoint else None
+    if checkpoint and checkpoint["version"] > version:
+        # Інший процес уже працює за новішими правилами; цей підхопить їх при наступній перевірці
+        return 0
+    if checkpoint and checkpoint["version"] == version:
+        if checkpoint["finished"]:
+            _finished_version = version
+            return 0
+        last_id = checkpoint["last_id"]
+    else:
+        last_id = 0
+        logger.info(f"🔄 Перекатегоризація товарів за правилами версії {version}")
+    changed = 0
+    while get_rules_version() == version:
+        await wait_for_idle_pool()
+        rows = await get_items_after(last_id, RECATEGORIZE_BATCH_SIZE)
+        finished = len(rows) < RECATEGORIZE_BATCH_SIZE
+        new_last_id = rows[-1]["id"] if rows else last_id
+        categories = await categorize_rows(rows)
+        changes = [(row["id"], category) for row, category in zip(rows, categories) if category != row["category"]]
+        result = await recategorize_items(JOB_NAME, expected, version, new_last_id, changes, finished)
+        if result is None:
+            return changed
+        changed += result
+        expected, last_id = (version, new_last_id), new_last_id
+        if finished:
+            _finished_version = version
+            logger.info(f"✅ Перекатегоризацію завершено: змінено {changed} товарів")
+            return changed
+        await asyncio.sleep(pause)
+    return changed
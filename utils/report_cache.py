@@ -0,0 +1,95 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "1024"))
+# Страховка для кількох процесів: записи іншого процесу не інвалідують цей кеш
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "300"))
+
+# Ключ: (user_id, вид періоду, дата початку, дата кінця); None — межа відсутня
+_CACHE = OrderedDict()
+_today = None
+_generation = 0
+_hits = 0
+_misses = 0
+
+def resolve_period(user_id, period, from_date=None, to_date=None):
+    today = date.today()
+    if period == "day":
+        return (user_id, "day", today, today)
+    elif period == "week":
+        return (user_id, "week", today - timedelta(days=7), None)
+    elif period == "month":
+        return (user_id, "month", today.replace(day=1), None)
+    elif period == "custom" and from_date and to_date:
+        return (user_id, "custom", parse_date(from_date), parse_date(to_date))
+    return (user_id, "all", None, None)
+
+def parse_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value.strip(), "%Y-%m-%d").date()
+
+def _check_rollover():
+    # Після півночі ключі "day"/"week"/"month" зі старими датами більше не потрібні
+    global _today
+    today = date.today()
+    if today != _today:
+        _today = today
+        for key in [k for k in _CACHE if k[1] in ("day", "week", "month")]:
+            del _CACHE[key]
+
+def begin():
+    # Повертає мітку, з якою слід класти результат у кеш після запиту до бази
+    return _generation
+
+def get(key):
+    global _hits, _misses
+    _check_rollover()
+    entry = _CACHE.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        _CACHE.move_to_end(key)
+        _hits += 1
+        return entry[1]
+    if entry is not None:
+        del _CACHE[key]
+    _misses += 1
+    return None
+
+def put(key, data, token):
+    # Результат, прочитаний до інвалідації, міг уже застаріти — не кешуємо його
+    if token != _generation:
+        return
+    _check_rollover()
+    _CACHE[key] = (time.monotonic() + REPORT_CACHE_TTL, data)
+    _CACHE.move_to_end(key)
+    while len(_CACHE) > REPORT_CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+def covers(key, user_id, day):
+    owner, _, start, end = key
+    return owner == user_id and (start is None or start <= day) and (end is None or day <= end)
+
+def invalidate_dates(user_id, dates):
+    global _generation
+    dates = {parse_date(d) for d in dates}
+    if not dates:
+        return
+    _generation += 1
+    for key in [k for k in _CACHE if any(covers(k, user_id, d) for d in dates)]:
+        del _CACHE[key]
+
+def clear():
+    global _generation
+    _generation += 1
+    _CACHE.clear()
+
+def get_stats():
+    lookups = _hits + _misses
+    return {
+        "size": len(_CACHE),
+        "hits": _hits,
+        "misses": _misses,
+        "hit_ratio": round(_hits / lookups, 3) if lookups else 0.0,
+    }
@@ -0,0 +1,64 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Оновлення різних чатів обробляються паралельно (не більше max_concurrent_updates
+    # одночасно), а оновлення одного чату — строго по черзі, у порядку надходження,
+    # щоб діалоги ConversationHandler не бачили переставлених повідомлень.
+    #
+    # max_pending обмежує кількість прийнятих, але ще не оброблених оновлень; вебхук
+    # викликає admit() і при відмові просить Telegram повторити доставку пізніше.
+
+    def __init__(self, max_concurrent_updates, max_pending):
+        super().__init__(max_concurrent_updates=max_pending)
+        self.max_pending = max_pending
+        self.pending = 0
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> [lock, кількість оновлень цього чату в роботі]
+        self._chats = {}
+
+    def admit(self):
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        return True
+
+    async def do_process_update(self, update, coroutine):
+        key = chat_key(update)
+        try:
+            if key is None:
+                async with self._running:
+                    await coroutine
+                return
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                # Lock в asyncio віддається в порядку очікування, тож порядок чату зберігається
+                async with entry[0]:
+                    async with self._running:
+                        await coroutine
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chats[key]
+        finally:
+            self.pending -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def chat_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
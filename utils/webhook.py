@@ -0,0 +1,27 @@
+import hmac
+from collections import OrderedDict
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def check_secret_token(expected, received):
+    # Без налаштованого секрету перевірка вимкнена
+    if not expected:
+        return True
+    if not received:
+        return False
+    return hmac.compare_digest(expected.encode(), received.encode())
+
+class RecentUpdates:
+    # Останні прийняті update_id: Telegram повторює доставку, якщо не отримав відповідь вчасно
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._ids = OrderedDict()
+
+    def seen(self, update_id):
+        return update_id in self._ids
+
+    def add(self, update_id):
+        self._ids[update_id] = None
+        if len(self._ids) > self.maxlen:
+            self._ids.popitem(last=False)
@@ -0,0 +1,72 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from utils.metrics import observe_parse
+
+# inline — розбір прямо в циклі подій, thread — пул потоків, process — пул процесів
+PARSE_EXECUTOR = os.getenv("PARSE_EXECUTOR", "thread")
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 2)))
+# Скільки завдань може чекати на вільного воркера, перш ніж нові будуть відхилені
+PARSE_QUEUE_SIZE = int(os.getenv("PARSE_QUEUE_SIZE", "32"))
+
+EXECUTOR = None
+_RUNNING = None
+_waiting = 0
+
+class WorkerPoolBusy(Exception):
+    pass
+
+def init_workers():
+    global EXECUTOR, _RUNNING
+    if PARSE_EXECUTOR == "process":
+        EXECUTOR = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    elif PARSE_EXECUTOR == "thread":
+        EXECUTOR = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix="parse")
+    elif PARSE_EXECUTOR != "inline":
+        raise RuntimeError(f"Невідомий PARSE_EXECUTOR: {PARSE_EXECUTOR}")
+    _RUNNING = asyncio.Semaphore(PARSE_WORKERS)
+
+def close_workers():
+    global EXECUTOR
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown(wait=True, cancel_futures=True)
+        EXECUTOR = None
+
+def get_workers_stats():
+    running = PARSE_WORKERS - _RUNNING._value if _RUNNING is not None else 0
+    return {"mode": PARSE_EXECUTOR, "workers": PARSE_WORKERS, "running": running, "waiting": _waiting}
+
+async def run_parse(fn, *args, on_queued=None):
+    # Виконує fn(*args) у пулі воркерів. Якщо всі воркери зайняті, завдання стає в чергу
+    # (і викликається on_queued), а якщо заповнена і черга — піднімається WorkerPoolBusy.
+    global _waiting
+    if EXECUTOR is None:
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            observe_parse(fn.__name__, time.perf_counter() - started)
+    if _RUNNING.locked():
+        if _waiting >= PARSE_QUEUE_SIZE:
+            raise WorkerPoolBusy()
+        _waiting += 1
+        try:
+            if on_queued is not None:
+                await on_queued()
+            await _RUNNING.acquire()
+        finally:
+            _waiting -= 1
+    else:
+        await _RUNNING.acquire()
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, fn, *args)
+    finally:
+        observe_parse(fn.__name__, time.perf_counter() - started)
+        _RUNNING.release()